@@ -0,0 +1,374 @@
+"""Local stand-in for the Google Drive v3 endpoints used by cheaptrainerutils.
+
+Serves files.get (metadata and alt=media with Range), files.list with paging,
+files.delete, multipart / media / resumable create and update, and a token
+endpoint for service account and OAuth refreshes. Latency, per-connection
+bandwidth and a transient error rate are configurable, so the nodes' download
+and upload paths can be measured without a Google account or network.
+GET /_stats returns the request and byte counters, without counting itself.
+
+Run on its own with `python fake_drive.py --port 8765`, or start it in-process
+with `serve()`.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+THROTTLE_CHUNK = 64 * 1024
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class FakeDrive:
+    """In-memory Drive file store plus request counters."""
+
+    def __init__(self, latency=0.0, bandwidth=0.0, error_rate=0.0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._files = {}
+        self._data = {}
+        self._uploads = {}
+        self._stats = {"requests": 0, "bytes_out": 0, "bytes_in": 0, "errors": 0}
+
+    def add_folder(self, name, parent=None):
+        return self._store(name, b"", parent, FOLDER_MIME_TYPE)
+
+    def add_file(self, name, data, parent=None, mime_type="application/octet-stream"):
+        return self._store(name, data, parent, mime_type)
+
+    def find(self, name, parent=None):
+        with self._lock:
+            for file_info in self._files.values():
+                if file_info["name"] == name and (parent is None or parent in file_info["parents"]):
+                    return dict(file_info)
+        return None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _store(self, name, data, parent, mime_type, file_id=None):
+        file_id = file_id or uuid.uuid4().hex
+        file_info = {
+            "id": file_id,
+            "name": name,
+            "mimeType": mime_type,
+            "parents": [parent] if parent else [],
+            "modifiedTime": _now(),
+            "trashed": False,
+            "capabilities": {"canEdit": True, "canAddChildren": True},
+        }
+        if mime_type != FOLDER_MIME_TYPE:
+            file_info["md5Checksum"] = hashlib.md5(data).hexdigest()
+            file_info["size"] = str(len(data))
+        with self._lock:
+            previous = self._files.get(file_id)
+            if previous is not None:
+                file_info["parents"] = previous["parents"]
+                file_info["name"] = name or previous["name"]
+            self._files[file_id] = file_info
+            self._data[file_id] = bytes(data)
+        return dict(file_info)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeDrive/1.0"
+
+    @property
+    def drive(self):
+        return self.server.drive
+
+    def log_message(self, format, *args):
+        pass
+
+    # Plumbing
+
+    def _send(self, status, body=b"", headers=None, content_type="application/json", count=True):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        if body or status not in (204, 308):
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self._write_throttled(body, count)
+
+    def _error(self, status, message):
+        self._send(status, {"error": {"code": status, "message": message, "errors": [{"reason": message}]}})
+
+    def _throttle(self, sent, started):
+        if self.drive.bandwidth > 0:
+            delay = sent / self.drive.bandwidth - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _write_throttled(self, body, count=True):
+        started = time.perf_counter()
+        view = memoryview(body)
+        for offset in range(0, len(view), THROTTLE_CHUNK):
+            chunk = view[offset:offset + THROTTLE_CHUNK]
+            self.wfile.write(chunk)
+            self._throttle(offset + len(chunk), started)
+        if count:
+            self.drive._count("bytes_out", len(body))
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        started = time.perf_counter()
+        body = bytearray()
+        while len(body) < length:
+            chunk = self.rfile.read(min(THROTTLE_CHUNK, length - len(body)))
+            if not chunk:
+                break
+            body.extend(chunk)
+            self._throttle(len(body), started)
+        self.drive._count("bytes_in", len(body))
+        return bytes(body)
+
+    def _route(self, method):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self._read_body()
+        if url.path == "/_stats":
+            return self._send(200, self.drive.stats(), count=False)
+        self.drive._count("requests")
+        if self.drive.latency > 0:
+            time.sleep(self.drive.latency)
+        if url.path != "/token" and random.random() < self.drive.error_rate:
+            self.drive._count("errors")
+            return self._error(503, "backendError")
+
+        parts = [part for part in url.path.split("/") if part]
+        if url.path == "/token" and method == "POST":
+            return self._send(200, {"access_token": uuid.uuid4().hex, "expires_in": 3600, "token_type": "Bearer"})
+        if parts[:3] == ["upload", "drive", "v3"] and parts[3:4] == ["files"]:
+            return self._upload(method, parts[4] if len(parts) > 4 else None, query, body)
+        if parts[:3] == ["drive", "v3", "files"]:
+            file_id = parts[3] if len(parts) > 3 else None
+            if method == "GET" and file_id is None:
+                return self._list(query)
+            if method == "GET":
+                return self._get(file_id, query)
+            if method == "DELETE" and file_id is not None:
+                return self._delete(file_id)
+        return self._error(404, "notFound")
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_PUT(self):
+        self._route("PUT")
+
+    def do_PATCH(self):
+        self._route("PATCH")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+    # Endpoints
+
+    def _get(self, file_id, query):
+        with self.drive._lock:
+            file_info = self.drive._files.get(file_id)
+            data = self.drive._data.get(file_id)
+        if file_info is None or file_info["trashed"]:
+            return self._error(404, f"File not found: {file_id}")
+        if query.get("alt") != "media":
+            return self._send(200, file_info)
+
+        range_header = self.headers.get("Range")
+        if not range_header:
+            return self._send(200, data, content_type=file_info["mimeType"])
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header.strip())
+        if match is None:
+            return self._error(416, "Invalid range")
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+        if start >= len(data) and data:
+            return self._send(416, b"", {"Content-Range": f"bytes */{len(data)}"})
+        return self._send(
+            206, data[start:end + 1], {"Content-Range": f"bytes {start}-{end}/{len(data)}"},
+            content_type=file_info["mimeType"],
+        )
+
+    def _list(self, query):
+        q = query.get("q", "")
+        parent = re.search(r"'((?:\\'|[^'])*)' in parents", q)
+        name = re.search(r"name\s*=\s*'((?:\\.|[^'\\])*)'", q)
+        name = re.sub(r"\\(.)", r"\1", name.group(1)) if name else None
+        with self.drive._lock:
+            files = [
+                dict(f) for f in self.drive._files.values()
+                if not f["trashed"]
+                and (parent is None or parent.group(1) in f["parents"])
+                and (name is None or f["name"] == name)
+            ]
+        if query.get("orderBy", "").startswith("modifiedTime desc"):
+            files.sort(key=lambda f: f["modifiedTime"], reverse=True)
+        else:
+            files.sort(key=lambda f: f["name"])
+
+        page_size = min(int(query.get("pageSize", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        offset = int(query.get("pageToken") or 0)
+        response = {"files": files[offset:offset + page_size]}
+        if offset + page_size < len(files):
+            response["nextPageToken"] = str(offset + page_size)
+        return self._send(200, response)
+
+    def _delete(self, file_id):
+        with self.drive._lock:
+            found = self.drive._files.pop(file_id, None)
+            self.drive._data.pop(file_id, None)
+        if found is None:
+            return self._error(404, f"File not found: {file_id}")
+        return self._send(204)
+
+    def _upload(self, method, file_id, query, body):
+        upload_type = query.get("uploadType")
+        if method == "PUT" and "upload_id" in query:
+            return self._resumable_chunk(query["upload_id"], body)
+        if upload_type == "resumable":
+            upload_id = uuid.uuid4().hex
+            metadata = json.loads(body) if body else {}
+            with self.drive._lock:
+                self.drive._uploads[upload_id] = {"metadata": metadata, "file_id": file_id, "data": bytearray()}
+            host = self.headers.get("Host")
+            location = f"http://{host}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+            return self._send(200, b"", {"Location": location})
+        if upload_type == "multipart":
+            metadata, data = self._parse_multipart(body)
+            return self._finish_upload(metadata, file_id, data)
+        if upload_type == "media":
+            return self._finish_upload({}, file_id, body)
+        return self._error(400, "Unsupported uploadType")
+
+    def _resumable_chunk(self, upload_id, body):
+        with self.drive._lock:
+            upload = self.drive._uploads.get(upload_id)
+        if upload is None:
+            return self._error(404, "Upload session not found")
+        content_range = self.headers.get("Content-Range", "")
+        match = re.fullmatch(r"bytes (\*|(\d+)-(\d+))/(\d+|\*)", content_range.strip())
+        if match is None:
+            return self._error(400, "Invalid Content-Range")
+        data = upload["data"]
+        if match.group(1) != "*":
+            start = int(match.group(2))
+            if start > len(data):
+                return self._error(400, "Chunk starts after the committed data")
+            del data[start:]
+            data.extend(body)
+        total = match.group(4)
+        if total != "*" and len(data) >= int(total):
+            with self.drive._lock:
+                self.drive._uploads.pop(upload_id, None)
+            return self._finish_upload(upload["metadata"], upload["file_id"], bytes(data))
+        headers = {"Range": f"bytes=0-{len(data) - 1}"} if data else {}
+        return self._send(308, b"", headers)
+
+    def _finish_upload(self, metadata, file_id, data):
+        parent = (metadata.get("parents") or [None])[0]
+        mime_type = metadata.get("mimeType", "application/octet-stream")
+        if file_id is not None:
+            with self.drive._lock:
+                existing = self.drive._files.get(file_id)
+            if existing is None:
+                return self._error(404, f"File not found: {file_id}")
+            mime_type = metadata.get("mimeType", existing["mimeType"])
+        file_info = self.drive._store(metadata.get("name"), data, parent, mime_type, file_id)
+        return self._send(200, {"id": file_info["id"], "name": file_info["name"]})
+
+    def _parse_multipart(self, body):
+        content_type = self.headers.get("Content-Type", "")
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode("utf-8")
+        delimiter = b"--" + boundary
+        # The generator picks the line ending, so take it from the first delimiter line.
+        newline = b"\r\n" if body[len(delimiter):len(delimiter) + 2] == b"\r\n" else b"\n"
+        parts = []
+        for part in (newline + body).split(newline + delimiter)[1:]:
+            if part.startswith(b"--"):
+                break
+            headers, content = part.split(newline * 2, 1)
+            parts.append(content)
+        return json.loads(parts[0] or b"{}"), parts[1] if len(parts) > 1 else b""
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+@contextmanager
+def serve(drive=None, host="127.0.0.1", port=0):
+    """Run a fake Drive server in a background thread; yields `(drive, root_url)`."""
+    drive = drive or FakeDrive()
+    server = _Server((host, port), _Handler)
+    server.drive = drive
+    thread = threading.Thread(target=server.serve_forever, name="fake-drive", daemon=True)
+    thread.start()
+    try:
+        yield drive, f"http://{host}:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def drive_discovery_document(root_url):
+    """The bundled Drive v3 discovery document, pointed at `root_url`."""
+    from googleapiclient.discovery_cache import get_static_doc
+
+    document = json.loads(get_static_doc("drive", "v3"))
+    document.update(rootUrl=root_url, mtlsRootUrl=root_url, baseUrl=root_url + document["servicePath"])
+    return document
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Delay added to every request")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0.0,
+                        help="Per-connection bandwidth in megabits per second, 0 for unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with a transient 503")
+    args = parser.parse_args()
+
+    drive = FakeDrive(args.latency_ms / 1000, args.bandwidth_mbps * 1e6 / 8, args.error_rate)
+    root = drive.add_folder("root")
+    with serve(drive, args.host, args.port) as (drive, root_url):
+        print(f"Fake Drive listening on {root_url} (empty root folder id {root['id']})")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
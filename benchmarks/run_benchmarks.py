@@ -0,0 +1,566 @@
+"""Offline benchmarks for the cheaptrainerutils nodes.
+
+Seeds a local fake Drive (see fake_drive.py) with synthetic datasets and LoRAs of
+several sizes, then runs every scenario against the real node code in a fresh
+subprocess, so each one starts with a cold cache and its peak RSS is its own.
+Reports wall time, throughput, peak RSS and the Drive traffic of each scenario;
+the JSON output also has the nodes' own per-stage metrics for each measured run.
+
+The nodes import ComfyUI modules, so this needs a ComfyUI checkout: by default the
+one this extension is installed in (`ComfyUI/custom_nodes/<extension>`). CLIP is a
+small synthetic text encoder, so caption encoding numbers measure the caching
+around it rather than a real model.
+
+    python benchmarks/run_benchmarks.py --latency-ms 20 --bandwidth-mbps 400
+    python benchmarks/run_benchmarks.py --scenarios 'cached_loader_*,lora_*' --json out.json
+"""
+import argparse
+import fnmatch
+import gzip
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from contextlib import contextmanager
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from fake_drive import FakeDrive, drive_discovery_document, serve
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+EXTENSION_DIR = os.path.dirname(BENCHMARK_DIR)
+RESULT_PREFIX = "BENCHMARK_RESULT "
+LORA_RANK = 32
+LORA_WIDTH = 3072
+CAPTION_COUNT = 256
+
+SCENARIOS = []
+
+
+def scenario(name, per=None):
+    """Register a scenario; `per` runs it once for every "dataset" or "lora" case."""
+    def register(func):
+        SCENARIOS.append((name, per, func))
+        return func
+    return register
+
+
+# Measurement helpers (child process)
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _rss_mb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _server_stats(root_url):
+    with urllib.request.urlopen(root_url + "_stats") as response:
+        return json.load(response)
+
+
+class Context:
+    """What a scenario gets: the loaded extension, the seeded spec and a timer."""
+
+    def __init__(self, module, spec, case, summaries):
+        self.module = module
+        self.summaries = summaries
+        self.spec = spec
+        self.case = case
+        self.credentials_json = spec["credentials_json"]
+        self.oauth = spec["oauth"]
+        self.result = None
+
+    @contextmanager
+    def measure(self):
+        """Time the enclosed block; setup and warm-up runs stay outside it."""
+        before = _server_stats(self.spec["root_url"])
+        baseline = _rss_mb("VmRSS")
+        peak_reset = _reset_peak_rss()
+        first_summary = len(self.summaries)
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        after = _server_stats(self.spec["root_url"])
+        self.result = {
+            "seconds": seconds,
+            "rss_mb": baseline,
+            "peak_rss_mb": _rss_mb("VmHWM"),
+            "peak_rss_exact": peak_reset,
+            **{key: after[key] - before[key] for key in after},
+            "metrics": self.summaries[first_summary:],
+        }
+
+
+class SyntheticClip:
+    """Stand-in for comfy.sd.CLIP with the calls the loaders make."""
+
+    def __init__(self, dim=768, tokens=77):
+        import torch
+
+        self.torch = torch
+        self.dim = dim
+        self.tokens = tokens
+        self.cond_stage_model = torch.nn.Linear(dim, dim)
+        # Fixed weights, so every instance has the same fingerprint like a reloaded model.
+        generator = torch.Generator().manual_seed(0)
+        with torch.no_grad():
+            for parameter in self.cond_stage_model.parameters():
+                parameter.copy_(torch.randn(parameter.shape, generator=generator) / dim ** 0.5)
+        self.tokenizer = self
+
+    def tokenize(self, text):
+        return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+
+    def encode_from_tokens_scheduled(self, tokens):
+        torch = self.torch
+        generator = torch.Generator().manual_seed(tokens)
+        with torch.no_grad():
+            cond = self.cond_stage_model(torch.randn(1, self.tokens, self.dim, generator=generator))
+        return [[cond, {"pooled_output": cond[:, 0]}]]
+
+
+def _load_extension(spec, workdir):
+    sys.path.insert(0, spec["comfyui"])
+    for name in ("CHEAP_TRAINER_PREFETCH_FOLDERS", "CHEAP_TRAINER_PREFETCH_CREDENTIALS"):
+        os.environ.pop(name, None)
+    # Keep a prefetch.json next to the extension from downloading real datasets.
+    os.environ["CHEAP_TRAINER_PREFETCH_CONFIG"] = os.path.join(workdir, "no-prefetch.json")
+
+    import folder_paths
+    folder_paths.set_input_directory(os.path.join(workdir, "input"))
+    folder_paths.set_output_directory(os.path.join(workdir, "output"))
+
+    from googleapiclient.discovery import build_from_document
+
+    module_spec = importlib.util.spec_from_file_location(
+        "cheaptrainerutils", os.path.join(EXTENSION_DIR, "cheaptrainerutils.py")
+    )
+    module = importlib.util.module_from_spec(module_spec)
+    sys.modules["cheaptrainerutils"] = module
+    module_spec.loader.exec_module(module)
+
+    document = drive_discovery_document(spec["root_url"])
+    module._build_drive_service = lambda credentials: build_from_document(document, credentials=credentials)
+    module.OAUTH_TOKEN_URI = spec["root_url"] + "token"
+
+    # Keep the per-run metrics the nodes report, to store them with the results.
+    summaries = []
+    report_metrics = module._report_metrics
+
+    def record(summary):
+        summaries.append(summary)
+        report_metrics(summary)
+    module._report_metrics = record
+    return module, summaries
+
+
+def _run_child(job):
+    spec = job["spec"]
+    if job["verbose"]:
+        logging.basicConfig(level=logging.INFO)
+    module, summaries = _load_extension(spec, job["workdir"])
+    func = next(func for name, per, func in SCENARIOS if name == job["scenario"])
+    context = Context(module, spec, job["case"], summaries)
+    counts = func(context)
+    print(RESULT_PREFIX + json.dumps(dict(context.result, **counts)), flush=True)
+
+
+# Scenarios
+
+def _dataset(context):
+    return context.spec["datasets"][context.case]
+
+
+def _lora(context):
+    return context.spec["loras"][context.case]
+
+
+@scenario("list_tree")
+def list_tree(context):
+    client = context.module._service_account_client(context.credentials_json)
+    with context.measure():
+        files = context.module._list_tree(client, context.spec["listing_folder_id"])
+    return {"items": len(files), "bytes": 0}
+
+
+def _load_uncached(context, folder_id):
+    node = context.module.textImagePairFromGoogleDrive()
+    return node.textImagePairing(folder_id, SyntheticClip(), context.credentials_json,
+                                 resolution=context.spec["resolution"])
+
+
+def _load_cached(context, folder_id, **kwargs):
+    node = context.module.textImagePairFromGoogleDriveCached()
+    return node.textImagePairing(folder_id, SyntheticClip(), context.credentials_json,
+                                 resolution=context.spec["resolution"], **kwargs)
+
+
+@scenario("uncached_loader", per="dataset")
+def uncached_loader(context):
+    dataset = _dataset(context)
+    with context.measure():
+        _load_uncached(context, dataset["folder_id"])
+    return {"items": dataset["pairs"], "bytes": dataset["bytes"]}
+
+
+@scenario("cached_loader_cold", per="dataset")
+def cached_loader_cold(context):
+    dataset = _dataset(context)
+    with context.measure():
+        _load_cached(context, dataset["folder_id"])
+    return {"items": dataset["pairs"], "bytes": dataset["bytes"]}
+
+
+@scenario("cached_loader_warm", per="dataset")
+def cached_loader_warm(context):
+    dataset = _dataset(context)
+    _load_cached(context, dataset["folder_id"])
+    with context.measure():
+        _load_cached(context, dataset["folder_id"])
+    return {"items": dataset["pairs"], "bytes": dataset["bytes"]}
+
+
+@scenario("streaming_loader", per="dataset")
+def streaming_loader(context):
+    dataset = _dataset(context)
+    items = 0
+    with context.measure():
+        stream = _load_cached(context, dataset["folder_id"], streaming=True, stream_batch_size=8)[3]
+        for images, conditioning in stream:
+            items += images.shape[0]
+    return {"items": items, "bytes": dataset["bytes"]}
+
+
+@scenario("pack_dataset", per="dataset")
+def pack_dataset(context):
+    dataset = _dataset(context)
+    node = context.module.packDatasetToGoogleDrive()
+    with context.measure():
+        node.pack_dataset(dataset["packed_folder_id"], **context.oauth, shard_size_mb=64)
+    return {"items": dataset["pairs"], "bytes": dataset["bytes"]}
+
+
+@scenario("archive_loader_cold", per="dataset")
+def archive_loader_cold(context):
+    dataset = _dataset(context)
+    with context.measure():
+        _load_cached(context, dataset["packed_folder_id"])
+    return {"items": dataset["pairs"], "bytes": dataset["bytes"]}
+
+
+def _captions():
+    return [f"a photo of sks subject, caption variant {i % (CAPTION_COUNT // 2)}" for i in range(CAPTION_COUNT)]
+
+
+@scenario("caption_encode_cold")
+def caption_encode_cold(context):
+    clip = SyntheticClip()
+    with context.measure():
+        context.module._encode_captions(clip, _captions())
+    return {"items": CAPTION_COUNT, "bytes": 0}
+
+
+@scenario("caption_encode_warm")
+def caption_encode_warm(context):
+    clip = SyntheticClip()
+    context.module._encode_captions(clip, _captions())
+    with context.measure():
+        context.module._encode_captions(clip, _captions())
+    return {"items": CAPTION_COUNT, "bytes": 0}
+
+
+def _make_lora(size_mb):
+    import torch
+
+    generator = torch.Generator().manual_seed(size_mb)
+    lora = {}
+    pair_bytes = 2 * LORA_RANK * LORA_WIDTH * 4
+    for i in range(max(1, size_mb * 1024 * 1024 // pair_bytes)):
+        prefix = f"lora_unet_single_blocks_{i}_linear1"
+        lora[f"{prefix}.lora_down.weight"] = torch.randn(LORA_RANK, LORA_WIDTH, generator=generator)
+        lora[f"{prefix}.lora_up.weight"] = torch.randn(LORA_WIDTH, LORA_RANK, generator=generator)
+        lora[f"{prefix}.alpha"] = torch.tensor(float(LORA_RANK))
+    return lora
+
+
+def _save_lora(context, **kwargs):
+    lora = _make_lora(_lora(context)["size_mb"])
+    node = context.module.SaveLoratoGoogleDrive()
+    with context.measure():
+        node.googledrivelorasave(
+            lora, "bench", **context.oauth, folder_id=context.spec["lora_folder_id"],
+            upload_mode="blocking", **kwargs,
+        )
+    return {"items": 1, "bytes": _lora(context)["bytes"]}
+
+
+@scenario("lora_save_local", per="lora")
+def lora_save_local(context):
+    return _save_lora(context)
+
+
+@scenario("lora_save_in_memory", per="lora")
+def lora_save_in_memory(context):
+    return _save_lora(context, keep_local_copy=False)
+
+
+@scenario("lora_save_fp16_compressed", per="lora")
+def lora_save_fp16_compressed(context):
+    return _save_lora(context, save_dtype="fp16", compression="zstd" if zstandard else "gzip")
+
+
+def _load_lora(context, name):
+    lora_file = context.module._lookup_lora_file(context.credentials_json, context.spec["lora_folder_id"], name)
+    node = context.module.loadLoraFromGoogleDrive()
+    return node._load_state_dict(lora_file, name, context.credentials_json)
+
+
+@scenario("lora_load_cold", per="lora")
+def lora_load_cold(context):
+    with context.measure():
+        _load_lora(context, _lora(context)["name"])
+    return {"items": 1, "bytes": _lora(context)["bytes"]}
+
+
+@scenario("lora_load_warm", per="lora")
+def lora_load_warm(context):
+    _load_lora(context, _lora(context)["name"])
+    with context.measure():
+        _load_lora(context, _lora(context)["name"])
+    return {"items": 1, "bytes": _lora(context)["bytes"]}
+
+
+@scenario("lora_load_compressed_cold", per="lora")
+def lora_load_compressed_cold(context):
+    with context.measure():
+        _load_lora(context, _lora(context)["compressed_name"])
+    return {"items": 1, "bytes": _lora(context)["bytes"]}
+
+
+# Seeding and reporting (parent process)
+
+def _service_account_json(root_url):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode("ascii")
+    return json.dumps({
+        "type": "service_account",
+        "project_id": "benchmark",
+        "private_key_id": "benchmark",
+        "private_key": pem,
+        "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+        "client_id": "1",
+        "token_uri": root_url + "token",
+    })
+
+
+def _synthetic_jpeg(size, seed):
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    image = np.stack([gradient[None, :].repeat(size, 0), gradient[:, None].repeat(size, 1),
+                      np.full((size, size), seed % 256, np.float32)], axis=-1)
+    image += rng.normal(0, 24, image.shape).astype(np.float32)
+    buffer = BytesIO()
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _seed_dataset(drive, root_id, size, count):
+    folder = drive.add_folder(f"dataset_{size}px", root_id)
+    packed = drive.add_folder(f"dataset_{size}px_packed", root_id)
+    total = 0
+    for i in range(count):
+        image = _synthetic_jpeg(size, i)
+        caption = f"a photo of sks subject, caption variant {i % 16}".encode("utf-8")
+        for parent in (folder["id"], packed["id"]):
+            drive.add_file(f"{i:05}.jpg", image, parent, "image/jpeg")
+            drive.add_file(f"{i:05}.txt", caption, parent, "text/plain")
+        total += len(image) + len(caption)
+    return {"folder_id": folder["id"], "packed_folder_id": packed["id"], "pairs": count, "bytes": total}
+
+
+def _seed_listing(drive, root_id, count, subfolders=10):
+    folder = drive.add_folder("listing", root_id)
+    for sub in range(subfolders):
+        child = drive.add_folder(f"1_part{sub}", folder["id"])
+        for i in range(sub, count, subfolders):
+            drive.add_file(f"{i:05}.txt", b"caption", child["id"], "text/plain")
+    return folder["id"]
+
+
+def _seed_lora(drive, folder_id, size_mb):
+    import safetensors.torch
+
+    data = safetensors.torch.save(_make_lora(size_mb))
+    name = f"bench_{size_mb}mb.safetensors"
+    drive.add_file(name, data, folder_id)
+    if zstandard is not None:
+        compressed_name, compressed = name + ".zst", zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        compressed_name, compressed = name + ".gz", gzip.compress(data, compresslevel=6)
+    drive.add_file(compressed_name, compressed, folder_id)
+    return {"name": name, "compressed_name": compressed_name, "size_mb": size_mb, "bytes": len(data)}
+
+
+def _cases(per, spec):
+    if per == "dataset":
+        return list(spec["datasets"])
+    if per == "lora":
+        return list(spec["loras"])
+    return [""]
+
+
+def _run_job(job, verbose):
+    with tempfile.TemporaryDirectory(prefix="cheap-trainer-bench-", dir=job["spec"]["workdir"]) as workdir:
+        job = dict(job, workdir=workdir)
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", json.dumps(job)],
+            cwd=BENCHMARK_DIR, stdout=subprocess.PIPE, stderr=None if verbose else subprocess.PIPE,
+            text=True,
+        )
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(
+        f"Scenario {job['scenario']} {job['case']} failed with exit code {process.returncode}:\n"
+        f"{process.stderr or ''}"
+    )
+
+
+def _report(results):
+    header = f"{'scenario':<28} {'case':<10} {'seconds':>9} {'items/s':>9} {'MB/s':>9} " \
+             f"{'peak RSS':>9} {'RSS +':>8} {'requests':>8} {'down MB':>9} {'up MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print(f"{r['scenario']:<28} {r['case']:<10} FAILED")
+            continue
+        seconds = max(r["seconds"], 1e-9)
+        print(
+            f"{r['scenario']:<28} {r['case']:<10} {r['seconds']:>9.3f} {r['items'] / seconds:>9.1f} "
+            f"{r['bytes'] / seconds / 1e6:>9.1f} {r['peak_rss_mb']:>9.0f} "
+            f"{r['peak_rss_mb'] - r['rss_mb']:>8.0f} {r['requests']:>8} "
+            f"{r['bytes_out'] / 1e6:>9.1f} {r['bytes_in'] / 1e6:>8.1f}"
+        )
+    if any(not r.get("peak_rss_exact", True) for r in results):
+        print("\nPeak RSS could not be reset per phase here, so it includes setup and warm-up runs.")
+
+
+def _parse_sizes(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--comfyui", default=os.path.dirname(os.path.dirname(EXTENSION_DIR)),
+                        help="ComfyUI checkout to import the nodes from")
+    parser.add_argument("--scenarios", default="*", help="Comma separated scenario names or patterns")
+    parser.add_argument("--images", type=int, default=64, help="Image-caption pairs per dataset")
+    parser.add_argument("--image-sizes", default="512,1536", help="Comma separated dataset image sizes")
+    parser.add_argument("--resolution", type=int, default=0, help="Loader resolution input")
+    parser.add_argument("--lora-mb", default="16,256", help="Comma separated LoRA sizes in MB")
+    parser.add_argument("--list-files", type=int, default=5000, help="Files in the listing benchmark tree")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Delay added to every Drive request")
+    parser.add_argument("--bandwidth-mbps", type=float, default=400.0,
+                        help="Per-connection bandwidth in megabits per second, 0 for unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of Drive requests answered with a transient 503")
+    parser.add_argument("--workdir", default=None, help="Where scenarios keep their caches (default: temp)")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the nodes' log output")
+    args = parser.parse_args()
+
+    if args.child:
+        _run_child(json.loads(args.child))
+        return
+
+    if not os.path.exists(os.path.join(args.comfyui, "folder_paths.py")):
+        parser.error(f"{args.comfyui} is not a ComfyUI checkout, pass --comfyui")
+    patterns = [p.strip() for p in args.scenarios.split(",") if p.strip()]
+    selected = [(name, per) for name, per, func in SCENARIOS
+                if any(fnmatch.fnmatch(name, p) for p in patterns)]
+
+    drive = FakeDrive(args.latency_ms / 1000, args.bandwidth_mbps * 1e6 / 8, args.error_rate)
+    workdir = tempfile.mkdtemp(prefix="cheap-trainer-bench-", dir=args.workdir)
+    results = []
+    try:
+        with serve(drive) as (drive, root_url):
+            print("Seeding the fake Drive...", flush=True)
+            root = drive.add_folder("benchmark")
+            lora_folder = drive.add_folder("loras", root["id"])
+            spec = {
+                "comfyui": os.path.abspath(args.comfyui),
+                "root_url": root_url,
+                "workdir": workdir,
+                "resolution": args.resolution,
+                "credentials_json": _service_account_json(root_url),
+                "oauth": {"client_id": "benchmark", "client_secret": "benchmark", "refresh_token": "benchmark"},
+                "listing_folder_id": _seed_listing(drive, root["id"], args.list_files),
+                "datasets": {f"{size}px": _seed_dataset(drive, root["id"], size, args.images)
+                             for size in _parse_sizes(args.image_sizes)},
+                "lora_folder_id": lora_folder["id"],
+                "loras": {f"{mb}MB": _seed_lora(drive, lora_folder["id"], mb) for mb in _parse_sizes(args.lora_mb)},
+            }
+
+            for name, per in selected:
+                for case in _cases(per, spec):
+                    print(f"Running {name} {case}...", flush=True)
+                    job = {"scenario": name, "case": case, "spec": spec, "verbose": args.verbose}
+                    try:
+                        result = _run_job(job, args.verbose)
+                    except RuntimeError as e:
+                        print(e, file=sys.stderr)
+                        result = {"error": str(e)}
+                    results.append(dict(result, scenario=name, case=case))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    _report(results)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"settings": {k: v for k, v in vars(args).items() if k != "child"}, "results": results}, f,
+                      indent=2)
+    if any("error" in r for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
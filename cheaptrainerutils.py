@@ -1,22 +1,2537 @@
 import folder_paths
+import atexit
+import bisect
+import contextvars
+import errno
+import gzip
+import hashlib
 import json
+import math
 import os
 import logging
+import platform
+import queue
+import random
+import re
+import shutil
+import socket
+import ssl
+import struct
+import threading
+import time
+import weakref
+import httplib2
 import safetensors.torch
-from io import BytesIO
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
+from io import BytesIO, RawIOBase
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload, MediaFileUpload
 from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from PIL import Image
 import numpy as np
 import torch
-import tempfile
 import comfy.utils
 import comfy.sd
 from comfy.comfy_types.node_typing import IO
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DRIVE_SCOPES = ["https://www.googleapis.com/auth/drive"]
+VALID_IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".webp"]
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+LIST_WORKERS = 8
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"ratelimitexceeded", "userratelimitexceeded"}
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 32.0
+DECODE_WORKERS = max(1, min(8, os.cpu_count() or 1))
+MANIFEST_NAME = ".manifest.json"
+GDRIVE_CACHE_DIR = "gdrive_cache"
+DEFAULT_CACHE_MAX_GB = 20.0
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+RANGED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+RANGED_DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+RANGED_DOWNLOAD_CONNECTIONS = 8
+PACK_PREFIX = "_dataset_pack"
+PACK_INDEX_NAME = "_dataset_pack.index.json"
+PACK_MERGE_GAP = 4 * 1024 * 1024
+PACK_MAX_SPAN = 256 * 1024 * 1024
+PACK_WORK_DIR = ".gdrive_packs"
+IMAGE_PACK_NAME = "images.pack"
+CAPTION_ENCODE_BATCH = 32
+CLIP_FINGERPRINT_SAMPLE = 64
+BUCKET_MODES = ["off", "aspect_buckets"]
+BUCKET_STEP = 64
+BUCKET_MAX_ASPECT = 4.0
+IMAGE_DTYPES = ["float32", "uint8"]
+UPLOAD_STATE_DIR = ".gdrive_uploads"
+UPLOAD_MODES = ["background", "blocking"]
+UPLOAD_QUEUE_SIZE = 4
+UPLOAD_HISTORY = 100
+SAVE_DTYPES = {"keep": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+COMPRESSION_MODES = ["none", "zstd", "gzip"]
+COMPRESSION_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+ORIGINAL_DTYPES_KEY = "cheap_trainer_utils.original_dtypes"
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+LORA_LOOKUP_TTL = 30.0
+FOLDER_CHECK_TTL = 300.0
+OAUTH_TOKEN_URI = "https://oauth2.googleapis.com/token"
+PREFETCH_CONFIG_NAME = "prefetch.json"
+PREFETCH_CONFIG_ENV = "CHEAP_TRAINER_PREFETCH_CONFIG"
+PREFETCH_FOLDERS_ENV = "CHEAP_TRAINER_PREFETCH_FOLDERS"
+PREFETCH_CREDENTIALS_ENV = "CHEAP_TRAINER_PREFETCH_CREDENTIALS"
+METRICS_FILE_ENV = "CHEAP_TRAINER_METRICS_FILE"
+METRICS_PREFIX = "cheap_trainer"
+
+
+class RunMetrics:
+    """Stage timings and counters of one node execution.
+
+    Stages are timed on whichever thread runs them, so a stage that runs on a worker
+    pool adds up the time of every worker and can exceed the run's wall time.
+    Counters named `<cache>_hits` and `<cache>_misses` get a hit ratio in the summary.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.status = "ok"
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = Counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                seconds, calls = self._stages.get(name, (0.0, 0))
+                self._stages[name] = (seconds + elapsed, calls + 1)
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def summary(self):
+        with self._lock:
+            stages = {
+                name: {"seconds": round(seconds, 6), "calls": calls}
+                for name, (seconds, calls) in self._stages.items()
+            }
+            counters = dict(self._counters)
+        return {
+            "node": self.node,
+            "status": self.status,
+            "host": platform.node(),
+            "wall_seconds": round(time.perf_counter() - self._start, 6),
+            "stages": stages,
+            "counters": counters,
+            "hit_ratios": _hit_ratios(counters),
+        }
+
+
+def _hit_ratios(counters):
+    caches = {name.rsplit("_", 1)[0] for name in counters if name.endswith(("_hits", "_misses"))}
+    ratios = {}
+    for cache in sorted(caches):
+        hits, misses = counters.get(f"{cache}_hits", 0), counters.get(f"{cache}_misses", 0)
+        if hits + misses:
+            ratios[cache] = round(hits / (hits + misses), 4)
+    return ratios
+
+
+_current_metrics = contextvars.ContextVar("cheap_trainer_metrics", default=None)
+_metrics_totals = {}
+_metrics_totals_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add(name, amount)
+
+
+@contextmanager
+def _stage(name):
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.stage(name):
+        yield
+
+
+def _carry_metrics(func):
+    """Wrap `func` so that it records into the caller's metrics on a worker thread."""
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return func
+
+    @wraps(func)
+    def run(*args, **kwargs):
+        token = _current_metrics.set(metrics)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_metrics.reset(token)
+    return run
+
+
+@contextmanager
+def _metered(node):
+    """Collect RunMetrics for the enclosed work and report them when it ends."""
+    metrics = RunMetrics(node)
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    except BaseException:
+        metrics.status = "error"
+        raise
+    finally:
+        _current_metrics.reset(token)
+        _report_metrics(metrics.summary())
+
+
+def _instrumented(method):
+    """Run a node's FUNCTION under `_metered`, named after the node class."""
+    @wraps(method)
+    def run(self, *args, **kwargs):
+        with _metered(type(self).__name__):
+            return method(self, *args, **kwargs)
+    return run
+
+
+def _report_metrics(summary):
+    """Log the JSON summary of a run and update the Prometheus file, if one is configured."""
+    logging.info(f"Cheap Trainer Utils metrics: {json.dumps(summary)}")
+    path = os.environ.get(METRICS_FILE_ENV)
+    if not path:
+        return
+    with _metrics_totals_lock:
+        totals = _metrics_totals.setdefault(
+            summary["node"], {"runs": Counter(), "stages": {}, "counters": Counter(), "last_wall_seconds": 0.0}
+        )
+        totals["runs"][summary["status"]] += 1
+        for name, stage in summary["stages"].items():
+            seconds, calls = totals["stages"].get(name, (0.0, 0))
+            totals["stages"][name] = (seconds + stage["seconds"], calls + stage["calls"])
+        totals["counters"].update(summary["counters"])
+        totals["last_wall_seconds"] = summary["wall_seconds"]
+        text = _prometheus_text(_metrics_totals)
+        try:
+            _atomic_write(os.path.expanduser(path), text.encode("utf-8"))
+        except OSError as e:
+            logging.warning(f"Could not write metrics file {path}: {e}")
+
+
+def _prometheus_text(totals):
+    """Cumulative totals of every node in the Prometheus text exposition format."""
+    families = OrderedDict()
+
+    def sample(name, kind, help_text, labels, value):
+        family = families.setdefault(name, (kind, help_text, []))
+        label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+        family[2].append(f"{name}{{{label_text}}} {value}")
+
+    for node, node_totals in sorted(totals.items()):
+        for status, runs in sorted(node_totals["runs"].items()):
+            sample(f"{METRICS_PREFIX}_runs_total", "counter", "Node executions.",
+                   {"node": node, "status": status}, runs)
+        sample(f"{METRICS_PREFIX}_last_run_seconds", "gauge", "Wall time of the latest execution.",
+               {"node": node}, node_totals["last_wall_seconds"])
+        for stage, (seconds, calls) in sorted(node_totals["stages"].items()):
+            sample(f"{METRICS_PREFIX}_stage_seconds_total", "counter",
+                   "Time spent per stage, added up over worker threads.",
+                   {"node": node, "stage": stage}, round(seconds, 6))
+            sample(f"{METRICS_PREFIX}_stage_calls_total", "counter", "Times each stage ran.",
+                   {"node": node, "stage": stage}, calls)
+        for name, value in sorted(node_totals["counters"].items()):
+            sample(f"{METRICS_PREFIX}_{name}_total", "counter", f"Total {name.replace('_', ' ')}.",
+                   {"node": node}, value)
+        for cache, ratio in _hit_ratios(node_totals["counters"]).items():
+            sample(f"{METRICS_PREFIX}_cache_hit_ratio", "gauge", "Cache hits over all lookups.",
+                   {"node": node, "cache": cache}, ratio)
+
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+def _service_account_credentials(credentials_json):
+    credentials_dict = json.loads(credentials_json)
+    return service_account.Credentials.from_service_account_info(
+        credentials_dict, scopes=DRIVE_SCOPES
+    )
+
+
+def _build_drive_service(credentials):
+    return build("drive", "v3", credentials=credentials, cache_discovery=False)
+
+
+def _check_folder(drive_service, folder_id, fields="id,name,mimeType"):
+    return drive_service.files().get(fileId=folder_id, fields=fields).execute()
+
+
+class DriveClient:
+    """One set of credentials plus a pool of Drive service objects built on them.
+
+    googleapiclient service objects wrap a single httplib2 connection and are not
+    thread-safe, so each caller borrows one for the duration of its requests and
+    returns it afterwards. Returned services keep their HTTP connections open, so
+    later requests from any thread or node reuse them instead of reconnecting.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._lock = threading.Lock()
+        self._idle = []
+        self._folders = {}
+
+    @contextmanager
+    def borrow(self):
+        # Refreshing here rather than inside the first request keeps concurrent
+        # borrowers from each fetching a token.
+        self.refresh_if_needed()
+        with self._lock:
+            drive_service = self._idle.pop() if self._idle else None
+        if drive_service is None:
+            drive_service = _build_drive_service(self.credentials)
+        try:
+            yield drive_service
+        finally:
+            with self._lock:
+                self._idle.append(drive_service)
+
+    def refresh_if_needed(self):
+        with self._lock:
+            if not self.credentials.valid:
+                with _stage("auth"):
+                    self.credentials.refresh(Request())
+
+    def check_folder(self, folder_id, fields="id,name,mimeType", max_age=FOLDER_CHECK_TTL, max_retries=5):
+        """`_check_folder` with retries, remembering successful checks for `max_age` seconds.
+
+        Raises ValueError when the folder can't be read, once transient errors have
+        used up their retries.
+        """
+        key = (folder_id, fields)
+        with self._lock:
+            cached = self._folders.get(key)
+        if cached is not None and time.monotonic() - cached[0] < max_age:
+            return cached[1]
+
+        def attempt():
+            with self.borrow() as drive_service, _stage("check_folder"):
+                return _check_folder(drive_service, folder_id, fields)
+
+        try:
+            folder_info = _with_retries(attempt, max_retries, f"Check of folder {folder_id}")
+        except Exception as e:
+            raise ValueError(f"Cannot access folder {folder_id}: {e}")
+        with self._lock:
+            self._folders[key] = (time.monotonic(), folder_info)
+        return folder_info
+
+
+_drive_clients = {}
+_drive_clients_lock = threading.Lock()
+
+
+def _registered_client(fingerprint, make_credentials):
+    with _drive_clients_lock:
+        client = _drive_clients.get(fingerprint)
+    if client is None:
+        client = DriveClient(make_credentials())
+        with _drive_clients_lock:
+            client = _drive_clients.setdefault(fingerprint, client)
+    return client
+
+
+def _service_account_client(credentials_json):
+    fingerprint = "service_account:" + hashlib.sha256(credentials_json.strip().encode("utf-8")).hexdigest()
+    return _registered_client(fingerprint, lambda: _service_account_credentials(credentials_json))
+
+
+def _oauth_client(client_id, client_secret, refresh_token):
+    client_id, client_secret, refresh_token = client_id.strip(), client_secret.strip(), refresh_token.strip()
+    secret = f"{client_id}\0{client_secret}\0{refresh_token}"
+    fingerprint = "oauth:" + hashlib.sha256(secret.encode("utf-8")).hexdigest()
+    return _registered_client(fingerprint, lambda: Credentials(
+        token=None,
+        refresh_token=refresh_token,
+        token_uri=OAUTH_TOKEN_URI,
+        client_id=client_id,
+        client_secret=client_secret,
+        scopes=DRIVE_SCOPES
+    ))
+
+
+def _list_folder(drive_service, folder_id):
+    query = f"'{folder_id}' in parents and trashed=false"
+    files = []
+    page_token = None
+    while True:
+        results = (
+            drive_service.files()
+            .list(
+                q=query,
+                corpora='user',
+                includeItemsFromAllDrives=False,
+                supportsAllDrives=False,
+                fields="nextPageToken, files(id, name, mimeType, md5Checksum, modifiedTime, size)",
+                pageSize=1000,
+                pageToken=page_token
+            )
+            .execute()
+        )
+        _count("list_requests")
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+
+def _list_tree(client, folder_id, recursive=True, max_retries=5, list_workers=LIST_WORKERS):
+    """List a Drive folder and, with `recursive`, every folder below it.
+
+    Each level of the tree is listed concurrently, every folder through its own
+    paginated requests. Files below the root are returned with their path relative
+    to it as `name` (for example `10_dog/001.png`); folders themselves are not
+    returned.
+    """
+    def list_one(folder):
+        folder_id, prefix = folder
+
+        def attempt():
+            with client.borrow() as drive_service:
+                return _list_folder(drive_service, folder_id)
+        return prefix, _with_retries(attempt, max_retries, f"Listing of folder {prefix or folder_id}")
+
+    files = []
+    seen = {folder_id}
+    level = [(folder_id, "")]
+    with _stage("list"), ThreadPoolExecutor(max_workers=list_workers) as pool:
+        while level:
+            next_level = []
+            for prefix, listing in pool.map(_carry_metrics(list_one), level):
+                for f in listing:
+                    if f.get("mimeType") != FOLDER_MIME_TYPE:
+                        files.append(dict(f, name=prefix + f["name"]) if prefix else f)
+                    elif recursive and f["id"] not in seen:
+                        seen.add(f["id"])
+                        next_level.append((f["id"], f"{prefix}{f['name']}/"))
+            level = next_level
+    _count("files_listed", len(files))
+    return files
+
+
+def _repeats(name):
+    """Kohya-style repeat count of a pair, from the nearest `N_concept` folder in its path."""
+    for folder in reversed(name.split("/")[:-1]):
+        count, sep, concept = folder.partition("_")
+        if sep and concept and count.isdigit() and int(count) > 0:
+            return int(count)
+    return 1
+
+
+def _repeat_indices(indices, repeats):
+    """Each of `indices` repeated `repeats[index]` times.
+
+    The copies are spread over passes through `indices` instead of being adjacent,
+    so a repeated pair doesn't fill whole batches with itself.
+    """
+    passes = max((repeats[index] for index in indices), default=0)
+    return [index for count in range(passes) for index in indices if repeats[index] > count]
+
+
+def _is_dataset_file(name):
+    name = name.lower()
+    return name.endswith(".txt") or any(name.endswith(ext) for ext in VALID_IMAGE_EXTENSIONS)
+
+
+def _pair_files(files):
+    images = {
+        f["name"].rsplit(".", 1)[0]: f
+        for f in files
+        if any(f["name"].lower().endswith(ext) for ext in VALID_IMAGE_EXTENSIONS)
+    }
+    captions = {
+        f["name"].rsplit(".", 1)[0]: f
+        for f in files
+        if f["name"].lower().endswith(".txt")
+    }
+    paired_names = sorted(set(images.keys()) & set(captions.keys()))
+    return [(name, images[name], captions[name]) for name in paired_names]
+
+
+class TransferError(IOError):
+    """A transfer that went wrong in transit and is worth retrying: a checksum
+    mismatch, a short read or an expired upload session."""
+
+
+def _is_retryable(error):
+    if isinstance(error, HttpError):
+        if error.resp.status in RETRYABLE_STATUS_CODES:
+            return True
+        # Drive reports per-user quota exhaustion as a 403 rather than a 429.
+        return error.resp.status == 403 and bool(RATE_LIMIT_REASONS & _error_reasons(error))
+    # Other OSErrors (a full disk, missing permissions) won't go away by waiting.
+    return isinstance(error, (
+        TransferError, ConnectionError, TimeoutError, socket.gaierror, ssl.SSLError, httplib2.HttpLib2Error,
+    ))
+
+
+def _error_reasons(error):
+    try:
+        details = json.loads(error.content)["error"]
+        reasons = [item.get("reason") for item in details.get("errors", [])]
+        reasons.append(details.get("status"))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+    return {reason.lower() for reason in reasons if isinstance(reason, str)}
+
+
+def _with_retries(func, max_retries, description):
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+            delay *= 0.5 + random.random() / 2
+            attempt += 1
+            _count("retries")
+            logging.warning(
+                f"{description} failed ({e}), retrying in {delay:.1f}s ({attempt}/{max_retries})"
+            )
+            time.sleep(delay)
+
+
+def _download_bytes(drive_service, file_id):
+    request = drive_service.files().get_media(fileId=file_id)
+    buffer = BytesIO()
+    downloader = MediaIoBaseDownload(buffer, request)
+    done = False
+    with _stage("download"):
+        while not done:
+            status, done = downloader.next_chunk()
+    _count("bytes_downloaded", buffer.tell())
+    return buffer.getvalue()
+
+
+def _md5_hex(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def _file_md5(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.f.write(data)
+
+
+def _download_to_file(drive_service, file_info, path):
+    """Stream a Drive file to `path` chunk by chunk, checking its md5Checksum."""
+    request = drive_service.files().get_media(fileId=file_info["id"])
+    with open(path, "wb") as f, _stage("download"):
+        writer = _HashingWriter(f)
+        downloader = MediaIoBaseDownload(writer, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+        done = False
+        while not done:
+            status, done = downloader.next_chunk()
+        _count("bytes_downloaded", f.tell())
+    expected = file_info.get("md5Checksum")
+    if expected and writer.md5.hexdigest() != expected:
+        raise TransferError(f"Checksum mismatch downloading {file_info['name']}")
+    _count("files_downloaded")
+
+
+def _is_large(file_info):
+    return int(file_info.get("size") or 0) >= RANGED_DOWNLOAD_THRESHOLD
+
+
+def _ranged_download(client, file_info, write, max_retries=5, connections=RANGED_DOWNLOAD_CONNECTIONS,
+                     start=0, end=None):
+    """Fetch bytes `start` to `end` of a file as parallel HTTP Range requests.
+
+    Per-connection throughput on many hosts is well below the link speed, so large
+    files come down over several connections at once. Each range is retried on its
+    own. `write(offset, data)` places each part; parts finish out of order.
+    """
+    size = int(file_info["size"]) if end is None else end
+    first = start
+
+    def fetch_part(start):
+        end = min(start + RANGED_DOWNLOAD_PART_SIZE, size) - 1
+
+        def attempt():
+            with client.borrow() as drive_service, _stage("download"):
+                request = drive_service.files().get_media(fileId=file_info["id"])
+                request.headers["Range"] = f"bytes={start}-{end}"
+                data = request.execute()
+            _count("bytes_downloaded", len(data))
+            if len(data) != end - start + 1:
+                raise TransferError(
+                    f"Expected {end - start + 1} bytes of {file_info['name']} at {start}, got {len(data)}"
+                )
+            return data
+
+        write(start, _with_retries(attempt, max_retries, f"Download of {file_info['name']} at {start}"))
+
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        fetch_part = _carry_metrics(fetch_part)
+        parts = [pool.submit(fetch_part, start) for start in range(first, size, RANGED_DOWNLOAD_PART_SIZE)]
+        try:
+            for part in parts:
+                part.result()
+        except BaseException:
+            for part in parts:
+                part.cancel()
+            raise
+
+
+def _ranged_download_to_file(client, file_info, path, max_retries=5):
+    size = int(file_info["size"])
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+
+        if hasattr(os, "pwrite"):
+            def write(offset, data):
+                os.pwrite(fd, data, offset)
+        else:
+            write_lock = threading.Lock()
+
+            def write(offset, data):
+                with write_lock:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    os.write(fd, data)
+
+        _ranged_download(client, file_info, write, max_retries)
+    finally:
+        os.close(fd)
+    expected = file_info.get("md5Checksum")
+    if expected and _file_md5(path) != expected:
+        raise TransferError(f"Checksum mismatch downloading {file_info['name']}")
+    _count("files_downloaded")
+
+
+def _ranged_download_bytes(client, file_info, max_retries=5):
+    buffer = bytearray(int(file_info["size"]))
+
+    def write(offset, data):
+        buffer[offset:offset + len(data)] = data
+
+    _ranged_download(client, file_info, write, max_retries)
+    data = bytes(buffer)
+    expected = file_info.get("md5Checksum")
+    if expected and _md5_hex(data) != expected:
+        raise TransferError(f"Checksum mismatch downloading {file_info['name']}")
+    return data
+
+
+def _find_file(drive_service, folder_id, name):
+    escaped_name = name.replace("\\", "\\\\").replace("'", "\\'")
+    query = f"'{folder_id}' in parents and name='{escaped_name}' and trashed=false"
+    results = (
+        drive_service.files()
+        .list(
+            q=query,
+            corpora='user',
+            includeItemsFromAllDrives=False,
+            supportsAllDrives=False,
+            fields="files(id, name, md5Checksum, modifiedTime, size)",
+            orderBy="modifiedTime desc",
+            pageSize=1
+        )
+        .execute()
+    )
+    files = results.get('files', [])
+    return files[0] if files else None
+
+
+def _download_verified(drive_service, file_info):
+    data = _download_bytes(drive_service, file_info["id"])
+    expected = file_info.get("md5Checksum")
+    if expected and _md5_hex(data) != expected:
+        # TransferError is retryable, so a corrupted transfer is fetched again.
+        raise TransferError(f"Checksum mismatch downloading {file_info['name']}")
+    return data
+
+
+def _blob_key(file_info):
+    if file_info.get("md5Checksum"):
+        return file_info["md5Checksum"]
+    # Drive only omits md5Checksum for non-binary files; fall back to a revision key.
+    revision = f"{file_info['id']}:{file_info.get('modifiedTime')}"
+    return hashlib.sha1(revision.encode("utf-8")).hexdigest()
+
+
+class BlobCache:
+    """Content-addressed store of original Drive file bytes, keyed by md5Checksum.
+
+    Identical files are stored once no matter which folder they came from. When the
+    total size goes over `max_bytes` the least recently used blobs are evicted,
+    except for blobs that are pinned by a running node. A blob is downloaded by one
+    caller at a time; others asking for it wait for that download to finish.
+    """
+
+    def __init__(self, root, max_bytes=0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        self._total = 0
+        self._pinned = Counter()
+        self._in_flight = {}
+
+        os.makedirs(root, exist_ok=True)
+        found = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, filename, stat.st_size))
+        for mtime, key, size in sorted(found):
+            self._index[key] = size
+            self._total += size
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._index
+
+    def read(self, key, verify=True):
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+        if verify and len(key) == 32 and _md5_hex(data) != key:
+            logging.warning(f"Cached blob {key} is corrupted, discarding it")
+            self.discard(key)
+            return None
+        self.touch(key)
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, data)
+        self._add(key, len(data))
+        self.release([key])
+
+    def fetch(self, key, download, verify=True):
+        while True:
+            data = self.read(key, verify)
+            if data is not None:
+                _count("blob_cache_hits")
+                return data
+            if self.claim([key]):
+                break
+            self.wait(key)
+        _count("blob_cache_misses")
+        try:
+            data = download()
+            self.put(key, data)
+        finally:
+            self.release([key])
+        return data
+
+    def fetch_file(self, key, download_to, verify=True):
+        """Like `fetch`, but streams misses to disk with `download_to(path)` and returns the path."""
+        path = self.path(key)
+        while True:
+            if os.path.exists(path):
+                if not verify or len(key) != 32 or _file_md5(path) == key:
+                    self.touch(key)
+                    _count("blob_cache_hits")
+                    return path
+                logging.warning(f"Cached blob {key} is corrupted, discarding it")
+                self.discard(key)
+            if self.claim([key]):
+                break
+            self.wait(key)
+        _count("blob_cache_misses")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            download_to(temp_path)
+            os.replace(temp_path, path)
+            self._add(key, os.path.getsize(path))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.release([key])
+        return path
+
+    def add_file(self, key, source_path):
+        """Move a finished file into the cache under `key`, e.g. one written after `make_room`."""
+        path = self.path(key)
+        os.replace(source_path, path)
+        self._add(key, os.path.getsize(path))
+
+    def make_room(self, size):
+        """Evict unpinned blobs until `size` more bytes fit in the budget.
+
+        Returns False when they can't fit, because the pinned blobs alone leave too
+        little room.
+        """
+        with self._lock:
+            if self.max_bytes <= 0:
+                return True
+            pinned = sum(self._index.get(key, 0) for key in self._pinned)
+            if pinned + size > self.max_bytes:
+                return False
+            self._evict(self.max_bytes - size)
+            return self._total + size <= self.max_bytes
+
+    def claim(self, keys):
+        """Mark blobs as being downloaded by the caller.
+
+        Returns the keys that were claimed, leaving out blobs that are already cached
+        or being downloaded elsewhere. Each claimed key must end in `put` or `release`.
+        """
+        claimed = []
+        with self._lock:
+            for key in keys:
+                if key not in self._index and key not in self._in_flight:
+                    self._in_flight[key] = threading.Event()
+                    claimed.append(key)
+        return claimed
+
+    def release(self, keys):
+        with self._lock:
+            events = [self._in_flight.pop(key) for key in keys if key in self._in_flight]
+        for event in events:
+            event.set()
+
+    def wait(self, key):
+        """Block until a download of `key` running elsewhere has finished or failed."""
+        with self._lock:
+            event = self._in_flight.get(key)
+        if event is not None:
+            event.wait()
+
+    def touch(self, key):
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            self._forget(key)
+            return
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+
+    def remove_unused(self, keys):
+        """Delete blobs nothing refers to any more, skipping ones pinned or being downloaded.
+
+        Returns the number of blobs deleted.
+        """
+        with self._lock:
+            keys = [
+                key for key in keys
+                if key in self._index and self._pinned[key] <= 0 and key not in self._in_flight
+            ]
+        for key in keys:
+            self.discard(key)
+        return len(keys)
+
+    def discard(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+        self._forget(key)
+
+    def pin(self, keys):
+        with self._lock:
+            self._pinned.update(keys)
+
+    def unpin(self, keys):
+        with self._lock:
+            self._pinned.subtract(keys)
+            self._pinned += Counter()
+            self._evict()
+
+    @contextmanager
+    def pinned(self, keys):
+        keys = list(keys)
+        self.pin(keys)
+        try:
+            yield self
+        finally:
+            self.unpin(keys)
+
+    def _add(self, key, size):
+        with self._lock:
+            self._total += size - self._index.pop(key, 0)
+            self._index[key] = size
+            self._evict()
+
+    def _forget(self, key):
+        with self._lock:
+            # A concurrent put may have written the blob since the caller missed it.
+            if not os.path.exists(self.path(key)):
+                self._total -= self._index.pop(key, 0)
+
+    def _evict(self, limit=None):
+        if self.max_bytes <= 0:
+            return
+        target = self.max_bytes if limit is None else limit
+        if self._total <= target:
+            return
+        for key in list(self._index):
+            if self._total <= target:
+                break
+            if self._pinned[key] > 0:
+                continue
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Still open elsewhere (e.g. memory-mapped on Windows); try again later.
+                continue
+            self._total -= self._index.pop(key)
+        if limit is None and self._total > self.max_bytes:
+            logging.warning(
+                f"Google Drive cache holds {self._total / 1e9:.2f} GB of files in use, "
+                f"above its {self.max_bytes / 1e9:.2f} GB limit"
+            )
+
+
+_blob_cache = None
+_blob_cache_lock = threading.Lock()
+_clip_fingerprints = weakref.WeakKeyDictionary()
+
+
+def _get_blob_cache(max_gb=None):
+    global _blob_cache
+    with _blob_cache_lock:
+        if _blob_cache is None:
+            root = os.path.join(folder_paths.get_input_directory(), GDRIVE_CACHE_DIR, "blobs")
+            _blob_cache = BlobCache(root, int(DEFAULT_CACHE_MAX_GB * 1e9))
+    if max_gb is not None:
+        _blob_cache.max_bytes = int(max_gb * 1e9)
+    return _blob_cache
+
+
+def _fetch_bytes(client, file_info, max_retries=5):
+    if file_info.get("id") is None:
+        raise ValueError(f"{file_info['name']} is only stored in the dataset archive and could not be read from it")
+    if _is_large(file_info):
+        data = _ranged_download_bytes(client, file_info, max_retries)
+    else:
+        def attempt():
+            with client.borrow() as drive_service:
+                return _download_verified(drive_service, file_info)
+        data = _with_retries(attempt, max_retries, f"Download of {file_info['name']}")
+    _count("files_downloaded")
+    return data
+
+
+def _download_files(client, files, process, download_workers=8, max_retries=5, cache=None,
+                    prefetched=None):
+    """Download Drive files with a bounded worker pool.
+
+    Every finished download is handed to `process(file_info, data)` on a separate
+    decode pool, so decoding overlaps with the transfers still in flight. With a
+    `cache`, files already in it are read from disk instead, and files whose
+    md5Checksum is in `prefetched` are taken from that dict. Results come back in
+    the order of `files`.
+    """
+    prefetched = prefetched or {}
+
+    @_carry_metrics
+    def fetch(file_info, decode_pool):
+        data = prefetched.get(_blob_key(file_info))
+        if data is not None:
+            pass
+        elif cache is None:
+            data = _fetch_bytes(client, file_info, max_retries)
+        else:
+            data = cache.fetch(
+                _blob_key(file_info), lambda: _fetch_bytes(client, file_info, max_retries)
+            )
+        return decode_pool.submit(_carry_metrics(process), file_info, data)
+
+    with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as decode_pool:
+        download_pool = ThreadPoolExecutor(max_workers=max(1, download_workers))
+        try:
+            downloads = [download_pool.submit(fetch, f, decode_pool) for f in files]
+            results = [future.result().result() for future in downloads]
+        except BaseException:
+            download_pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        download_pool.shutdown(wait=True)
+    return results
+
+
+def _cached_fetcher(cache, client, max_retries=5):
+    """Return `fetch(file_info)` that reads a file from `cache`, downloading it on a miss."""
+    def fetch(file_info):
+        return cache.fetch(
+            _blob_key(file_info), lambda: _fetch_bytes(client, file_info, max_retries)
+        )
+    return fetch
+
+
+def _atomic_write(path, data):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def _manifest_entry(file_info):
+    return {
+        "id": file_info.get("id"),
+        "md5Checksum": file_info.get("md5Checksum"),
+        "modifiedTime": file_info.get("modifiedTime"),
+        "size": file_info.get("size"),
+    }
+
+
+def _load_manifest(cache_folder, folder_id):
+    manifest_path = os.path.join(cache_folder, MANIFEST_NAME)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("folder_id") != folder_id:
+        return {}
+    return manifest.get("files", {})
+
+
+def _manifest_blob_keys(cache_base_dir, skip_folder=None):
+    """Blob keys of the files listed in every folder manifest under `cache_base_dir`."""
+    keys = set()
+    for name in os.listdir(cache_base_dir):
+        folder = os.path.join(cache_base_dir, name)
+        if folder == skip_folder:
+            continue
+        try:
+            with open(os.path.join(folder, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+                entries = json.load(f).get("files", {})
+        except (OSError, ValueError, AttributeError):
+            continue
+        keys.update(_blob_key(entry) for entry in entries.values())
+    return keys
+
+
+def _save_manifest(cache_folder, folder_id, entries):
+    manifest = {"folder_id": folder_id, "files": entries}
+    _atomic_write(
+        os.path.join(cache_folder, MANIFEST_NAME),
+        json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"),
+    )
+
+
+def _read_pack(listing, fetch):
+    """Return the dataset archive described by the folder listing, or None.
+
+    `fetch(file_info)` returns the bytes of the index file.
+    """
+    by_name = {f["name"]: f for f in listing}
+    index_file = by_name.get(PACK_INDEX_NAME)
+    if index_file is None:
+        return None
+    try:
+        index = json.loads(fetch(index_file))
+        shards = [by_name[shard["name"]] for shard in index["shards"]]
+        return {"files": index["files"], "shards": shards}
+    except (ValueError, KeyError, OSError) as e:
+        logging.warning(f"Ignoring unusable dataset archive index: {e}")
+        return None
+
+
+def _dataset_files(listing, pack):
+    """Loose images and captions define the dataset; a folder with only an archive uses its index."""
+    loose = [f for f in listing if _is_dataset_file(f["name"])]
+    if loose or pack is None:
+        return loose
+    return [
+        {"id": None, "name": entry["name"], "md5Checksum": entry["md5Checksum"], "size": str(entry["size"])}
+        for entry in pack["files"]
+        if _is_dataset_file(entry["name"])
+    ]
+
+
+def _fetch_from_pack(client, pack, wanted, store, max_retries=5):
+    """Pull every file whose md5Checksum is in `wanted` out of the archive shards.
+
+    Entries close together in a shard are merged into one span and fetched with
+    ranged reads, so the whole dataset takes a few bulk transfers instead of one
+    request per file. Each file is checked and passed to `store(md5, data)`.
+    """
+    remaining = set(wanted)
+    by_shard = {}
+    for entry in pack["files"]:
+        if entry["md5Checksum"] in remaining:
+            remaining.discard(entry["md5Checksum"])
+            by_shard.setdefault(entry["shard"], []).append(entry)
+
+    with _stage("pack_fetch"):
+        for shard_index, entries in sorted(by_shard.items()):
+            shard = pack["shards"][shard_index]
+            entries.sort(key=lambda entry: entry["offset"])
+            spans = []
+            for entry in entries:
+                entry_end = entry["offset"] + entry["size"]
+                if spans and entry["offset"] - spans[-1][1] <= PACK_MERGE_GAP \
+                        and entry_end - spans[-1][0] <= PACK_MAX_SPAN:
+                    spans[-1][1] = max(spans[-1][1], entry_end)
+                    spans[-1][2].append(entry)
+                else:
+                    spans.append([entry["offset"], entry_end, [entry]])
+
+            for span_start, span_end, span_entries in spans:
+                buffer = bytearray(span_end - span_start)
+
+                def write(offset, data):
+                    buffer[offset - span_start:offset - span_start + len(data)] = data
+
+                _ranged_download(client, shard, write, max_retries, start=span_start, end=span_end)
+                for entry in span_entries:
+                    start = entry["offset"] - span_start
+                    data = bytes(buffer[start:start + entry["size"]])
+                    if _md5_hex(data) != entry["md5Checksum"]:
+                        raise TransferError(f"Checksum mismatch for {entry['name']} in {shard['name']}")
+                    store(entry["md5Checksum"], data)
+                    _count("pack_files_fetched")
+    return remaining
+
+
+def _sync_folder(client, folder_id, cache_folder, cache, max_retries=5, recursive=True):
+    """List the whole Drive folder tree and record it in the folder's manifest.
+
+    Returns the remote dataset files. Files that are new, changed, or whose blob is
+    missing from `cache` are logged; the caller fetches them through the cache.
+    When the folder has a dataset archive, missing files are bulk-fetched from it
+    into the cache first. Blobs of files deleted or replaced on Drive are removed
+    from the cache, unless another folder's manifest still lists the same content.
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    listing = _list_tree(client, folder_id, recursive, max_retries)
+    pack = _read_pack(
+        listing,
+        lambda f: cache.fetch(_blob_key(f), lambda: _fetch_bytes(client, f, max_retries)),
+    )
+    remote_files = _dataset_files(listing, pack)
+    remote_names = {f["name"] for f in remote_files}
+    entries = _load_manifest(cache_folder, folder_id)
+
+    removed = [name for name in entries if name not in remote_names]
+    stale = [
+        f for f in remote_files
+        if entries.get(f["name"]) != _manifest_entry(f) or _blob_key(f) not in cache
+    ]
+    unused = {_blob_key(entry) for entry in entries.values()} - {_blob_key(f) for f in remote_files}
+    if unused:
+        unused -= _manifest_blob_keys(os.path.dirname(cache_folder), skip_folder=cache_folder)
+    dropped = cache.remove_unused(unused)
+    if stale or removed:
+        logging.info(
+            f"Google Drive folder {folder_id}: {len(stale)} new or changed files, "
+            f"{len(removed)} removed, {len(remote_files) - len(stale)} up to date in cache, "
+            f"{dropped} old files dropped from the cache"
+        )
+
+    # Older versions kept re-encoded copies next to the manifest; the blobs replace them.
+    for name in os.listdir(cache_folder):
+        if _is_dataset_file(name):
+            os.remove(os.path.join(cache_folder, name))
+
+    _save_manifest(cache_folder, folder_id, {f["name"]: _manifest_entry(f) for f in remote_files})
+
+    if pack is not None:
+        # Files already being downloaded elsewhere (e.g. by the prefetcher) are skipped here.
+        missing = cache.claim({_blob_key(f) for f in remote_files})
+        try:
+            if missing:
+                with cache.pinned(_blob_key(f) for f in remote_files):
+                    _fetch_from_pack(client, pack, missing, cache.put, max_retries)
+        finally:
+            cache.release(missing)
+    return remote_files
+
+
+def _bucket_resolutions(resolution):
+    """Bucket sizes with roughly resolution² pixels, sides in multiples of BUCKET_STEP."""
+    area = resolution * resolution
+    buckets = set()
+    max_side = int(resolution * math.sqrt(BUCKET_MAX_ASPECT))
+    for width in range(BUCKET_STEP, max_side + BUCKET_STEP, BUCKET_STEP):
+        height = (area // width) // BUCKET_STEP * BUCKET_STEP
+        if height < BUCKET_STEP or max(width / height, height / width) > BUCKET_MAX_ASPECT:
+            continue
+        buckets.add((width, height))
+    return sorted(buckets) or [(resolution, resolution)]
+
+
+def _target_size(width, height, resolution, bucket_mode):
+    if resolution <= 0:
+        return None
+    if bucket_mode != "aspect_buckets":
+        return (resolution, resolution)
+    aspect = math.log(width / height)
+    return min(
+        _bucket_resolutions(resolution),
+        key=lambda size: abs(math.log(size[0] / size[1]) - aspect),
+    )
+
+
+def _resize_cover(pil_image, size):
+    """Scale the image to cover `size` and center-crop it, decoding JPEGs at reduced scale."""
+    width, height = pil_image.size
+    scale = max(size[0] / width, size[1] / height)
+    # JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale when that still covers the target,
+    # so large photos are never fully decoded.
+    pil_image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    pil_image = pil_image.convert("RGB")
+
+    width, height = pil_image.size
+    scale = max(size[0] / width, size[1] / height)
+    crop_width, crop_height = size[0] / scale, size[1] / scale
+    left, top = (width - crop_width) / 2, (height - crop_height) / 2
+    return pil_image.resize(
+        size, Image.LANCZOS, box=(left, top, left + crop_width, top + crop_height), reducing_gap=3.0
+    )
+
+
+def _decode_pair_file(file_info, data, resolution=0, bucket_mode="off"):
+    if file_info["name"].lower().endswith(".txt"):
+        return data.decode("utf-8").strip()
+    return _image_size(data, resolution, bucket_mode)
+
+
+def _open_image(source):
+    """Open image bytes or a file path lazily; only the header is read until pixels are needed."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    return Image.open(source)
+
+
+def _image_size(source, resolution=0, bucket_mode="off"):
+    """Output (width, height) of an image, from its header alone."""
+    with _open_image(source) as pil_image:
+        size = _target_size(pil_image.width, pil_image.height, resolution, bucket_mode)
+        return size or pil_image.size
+
+
+def _decode_image(source, resolution=0, bucket_mode="off"):
+    with _stage("decode"):
+        pil_image = _open_image(source)
+        target = _target_size(pil_image.width, pil_image.height, resolution, bucket_mode)
+        if target is not None:
+            pil_image = _resize_cover(pil_image, target)
+        else:
+            pil_image = pil_image.convert("RGB")
+        image = np.asarray(pil_image)
+    _count("images_decoded")
+    return image
+
+
+class ImageBatch:
+    """Preallocated IMAGE output that images are decoded straight into.
+
+    Image sizes are known from the file headers up front, so there is one tensor per
+    output size (bucket, sorted by width, then height) and every image is written
+    into its slice as soon as it is decoded. Peak memory is about one copy of the
+    final batch plus one image per decode worker, with no stacking or concatenation.
+    """
+
+    def __init__(self, sizes, image_dtype="float32", pin_memory=False):
+        groups = {}
+        for index, size in enumerate(sizes):
+            groups.setdefault(tuple(size), []).append(index)
+        self.buckets = sorted(groups.items())
+        # Pinned memory needs a CUDA runtime; without one it's plain memory.
+        pin_memory = pin_memory and torch.cuda.is_available()
+        dtype = torch.uint8 if image_dtype == "uint8" else torch.float32
+        self.tensors = []
+        self._slots = {}
+        for (width, height), indices in self.buckets:
+            tensor = torch.empty((len(indices), height, width, 3), dtype=dtype, pin_memory=pin_memory)
+            self.tensors.append(tensor)
+            for position, index in enumerate(indices):
+                self._slots[index] = (tensor, position)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def write(self, index, image):
+        """Copy one HxWx3 uint8 array into its slot, scaling to 0..1 for float output."""
+        tensor, position = self._slots[index]
+        target = tensor[position].numpy()
+        if target.dtype == np.uint8:
+            target[...] = image
+        else:
+            np.divide(image, np.float32(255.0), out=target)
+
+    def fill(self, load, pack=None):
+        """Write `load(index)` into every slot on the decode pool, also into `pack` if given."""
+        def fill_one(index):
+            image = load(index)
+            self.write(index, image)
+            if pack is not None:
+                pack.write(index, image)
+
+        with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as decode_pool:
+            list(decode_pool.map(_carry_metrics(fill_one), range(len(self))))
+        return self
+
+
+def _linked_outputs(prompt, unique_id):
+    """Output slots of node `unique_id` that other nodes in `prompt` read.
+
+    Returns None when the node isn't run from a ComfyUI prompt.
+    """
+    if not prompt or unique_id is None:
+        return None
+    linked = set()
+    for node in prompt.values():
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2 and str(value[0]) == str(unique_id):
+                linked.add(value[1])
+    return linked
+
+
+def _check_image_sizes(sizes, bucket_mode, linked):
+    """Fail before decoding when the images can't be one IMAGE batch but are used as one."""
+    count = len(set(map(tuple, sizes)))
+    if count <= 1:
+        return
+    if bucket_mode != "aspect_buckets":
+        raise ValueError(
+            f"The images have {count} different sizes and can't be batched together. Set a resolution "
+            "to crop them all to the same size, or use bucket_mode aspect_buckets with the IMAGE_BATCHES output."
+        )
+    if linked is not None and 0 in linked:
+        raise ValueError(
+            f"The images fall into {count} aspect ratio buckets, which can't be one IMAGE batch. "
+            "Connect the IMAGE_BATCHES output instead of IMAGE."
+        )
+
+
+def _assemble_batch(names, batch, caption_texts, repeats=None):
+    """Turn a filled ImageBatch into the loader outputs.
+
+    Returns the IMAGE output, the list of per-bucket batches, the captions and the
+    bucket description. With a single bucket the order is unchanged and the IMAGE
+    output is that batch. With several, pairs are reordered bucket by bucket (buckets
+    sorted by width, then height) and the IMAGE output is None; the batches are only
+    available as IMAGE_BATCHES.
+
+    Every pair is stored once. A bucket's `indices` list each pair `repeats` times,
+    so repeated concepts are sampled more often without copying any image tensors.
+    """
+    repeats = list(repeats) if repeats is not None else [1] * len(names)
+    if len(batch.buckets) == 1:
+        (width, height), indices = batch.buckets[0]
+        description = {
+            "names": list(names),
+            "repeats": repeats,
+            "buckets": [{
+                "width": width,
+                "height": height,
+                "indices": _repeat_indices(range(len(names)), repeats),
+            }],
+        }
+        return batch.tensors[0], list(batch.tensors), caption_texts, description
+
+    ordered_names = []
+    ordered_captions = []
+    ordered_repeats = []
+    buckets = []
+    for (width, height), indices in batch.buckets:
+        start = len(ordered_names)
+        ordered_names.extend(names[i] for i in indices)
+        ordered_captions.extend(caption_texts[i] for i in indices)
+        ordered_repeats.extend(repeats[i] for i in indices)
+        buckets.append({
+            "width": width,
+            "height": height,
+            "indices": _repeat_indices(range(start, start + len(indices)), ordered_repeats),
+        })
+    description = {"names": ordered_names, "repeats": ordered_repeats, "buckets": buckets}
+    return None, list(batch.tensors), ordered_captions, description
+
+
+def _dataset_loader_inputs():
+    return {
+        "download_workers": (
+            "INT",
+            {
+                "default": 8,
+                "min": 1,
+                "max": 64,
+                "tooltip": "Number of files downloaded from Google Drive in parallel.",
+            },
+        ),
+        "max_retries": (
+            "INT",
+            {
+                "default": 5,
+                "min": 0,
+                "max": 20,
+                "tooltip": "How many times a failed download is retried, with exponential backoff.",
+            },
+        ),
+        "resolution": (
+            "INT",
+            {
+                "default": 0,
+                "min": 0,
+                "max": 8192,
+                "step": BUCKET_STEP,
+                "tooltip": "Target training resolution. Images are downscaled while decoding and center-cropped. 0 keeps the original size.",
+            },
+        ),
+        "bucket_mode": (
+            BUCKET_MODES,
+            {
+                "default": "off",
+                "tooltip": "off: every image becomes resolution x resolution. aspect_buckets: each image goes to the bucket with the closest aspect ratio and about resolution² pixels.",
+            },
+        ),
+        "recursive": (
+            "BOOLEAN",
+            {
+                "default": True,
+                "tooltip": "Also load pairs from subfolders. Folders named like 10_concept repeat their pairs 10 times (kohya style).",
+            },
+        ),
+        "image_dtype": (
+            IMAGE_DTYPES,
+            {
+                "default": "float32",
+                "tooltip": "float32: standard IMAGE in 0..1. uint8: raw 0..255 pixels, a quarter of the memory and host-to-device traffic; convert on the GPU.",
+            },
+        ),
+        "pin_memory": (
+            "BOOLEAN",
+            {
+                "default": False,
+                "tooltip": "Allocate the image batch in pinned memory for faster, asynchronous transfer to the GPU.",
+            },
+        ),
+    }
+
+
+def _clip_fingerprint(clip):
+    """Identify a CLIP model by its architecture, a sample of its weights and its patches."""
+    patcher = getattr(clip, "patcher", None)
+    patches_uuid = str(getattr(patcher, "patches_uuid", ""))
+    try:
+        cached = _clip_fingerprints.get(clip)
+    except TypeError:
+        cached = None
+    if cached is not None and cached[0] == patches_uuid:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    digest.update(type(clip.cond_stage_model).__name__.encode("utf-8"))
+    digest.update(type(clip.tokenizer).__name__.encode("utf-8"))
+    digest.update(repr(getattr(clip, "layer_idx", None)).encode("utf-8"))
+    digest.update(patches_uuid.encode("utf-8"))
+    state_dict = clip.cond_stage_model.state_dict()
+    for name in sorted(state_dict):
+        tensor = state_dict[name]
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode("utf-8"))
+        try:
+            sample = tensor.detach().flatten()[:CLIP_FINGERPRINT_SAMPLE].to("cpu", torch.float32)
+            digest.update(sample.numpy().tobytes())
+        except (RuntimeError, NotImplementedError):
+            pass
+    fingerprint = digest.hexdigest()
+
+    try:
+        _clip_fingerprints[clip] = (patches_uuid, fingerprint)
+    except TypeError:
+        pass
+    return fingerprint
+
+
+def _to_cpu(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu()
+    if isinstance(value, dict):
+        return {k: _to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(v) for v in value)
+    return value
+
+
+def _encode_captions(clip, caption_texts):
+    """Encode captions, memoizing each distinct caption on disk per CLIP fingerprint.
+
+    Duplicate captions are encoded once. Encoded conditioning is stored in the shared
+    blob cache, so it counts against the same disk budget and LRU eviction.
+    """
+    cache = _get_blob_cache()
+    fingerprint = _clip_fingerprint(clip)
+    unique_texts = list(dict.fromkeys(caption_texts))
+    keys = {
+        text: hashlib.sha256(f"{fingerprint}\0{text}".encode("utf-8")).hexdigest()
+        for text in unique_texts
+    }
+
+    encoded = {}
+    for text in unique_texts:
+        data = cache.read(keys[text], verify=False)
+        if data is None:
+            continue
+        try:
+            encoded[text] = torch.load(BytesIO(data), weights_only=True)
+        except Exception as e:
+            logging.warning(f"Discarding unreadable cached conditioning: {e}")
+            cache.discard(keys[text])
+
+    misses = [text for text in unique_texts if text not in encoded]
+    _count("caption_cache_hits", len(encoded))
+    _count("caption_cache_misses", len(misses))
+    if misses:
+        logging.info(
+            f"Encoding {len(misses)} of {len(unique_texts)} distinct captions "
+            f"({len(caption_texts)} total), the rest come from the conditioning cache"
+        )
+    # ComfyUI's CLIP wrapper only encodes one prompt per call (multiple token sections
+    # of a prompt are concatenated), so misses are encoded in groups and persisted
+    # after each group, keeping the model loaded between calls.
+    for start in range(0, len(misses), CAPTION_ENCODE_BATCH):
+        group = misses[start:start + CAPTION_ENCODE_BATCH]
+        with _stage("encode"):
+            for text in group:
+                encoded[text] = clip.encode_from_tokens_scheduled(clip.tokenize(text))
+        for text in group:
+            buffer = BytesIO()
+            torch.save(_to_cpu(encoded[text]), buffer)
+            cache.put(keys[text], buffer.getvalue())
+
+    conditions = []
+    for text in caption_texts:
+        conditions.extend(encoded[text])
+    return conditions
+
+
+def _pack_key(image_files, variant=""):
+    digest = hashlib.sha256(variant.encode("utf-8"))
+    for file_info in image_files:
+        digest.update(_blob_key(file_info).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ImagePackWriter:
+    """Builds a new image pack while the images are being decoded.
+
+    The pack pixels are stored in the blob cache under `key`, so they count against
+    its disk budget and are evicted like any other blob. The file is preallocated
+    from the output sizes and memory-mapped, so each decode worker copies its image
+    into place. `commit` publishes the pack with its index of shapes and offsets in
+    the folder's cache directory; `discard` drops it.
+
+    Raises OSError when the pack doesn't fit in the cache budget or on disk.
+    """
+
+    def __init__(self, cache_folder, cache, key, sizes):
+        self.key = key
+        self.cache = cache
+        self.index_path = os.path.join(cache_folder, f"{IMAGE_PACK_NAME}.json")
+        self.entries = []
+        offset = 0
+        for width, height in sizes:
+            self.entries.append({"shape": [height, width, 3], "offset": offset})
+            offset += height * width * 3
+        self.size = offset
+
+        if not cache.make_room(self.size):
+            raise OSError(
+                errno.ENOSPC,
+                f"a {self.size / 1e9:.2f} GB image pack does not fit in the "
+                f"{cache.max_bytes / 1e9:.2f} GB cache budget",
+            )
+        pack_path = cache.path(key)
+        os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+        free = shutil.disk_usage(os.path.dirname(pack_path)).free
+        if self.size > free:
+            raise OSError(
+                errno.ENOSPC,
+                f"a {self.size / 1e9:.2f} GB image pack does not fit in the {free / 1e9:.2f} GB of free disk space",
+            )
+
+        # Allocate every block up front: writing into a sparse memory map on a full
+        # disk kills the process with SIGBUS instead of raising an error.
+        self.temp_path = f"{pack_path}.{os.getpid()}.tmp"
+        try:
+            with open(self.temp_path, "wb") as f:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(f.fileno(), 0, max(1, offset))
+                else:
+                    f.truncate(max(1, offset))
+            self._packed = np.memmap(self.temp_path, dtype=np.uint8, mode="r+", shape=(max(1, offset),))
+        except BaseException:
+            os.remove(self.temp_path)
+            raise
+
+    def write(self, index, image):
+        offset = self.entries[index]["offset"]
+        self._packed[offset:offset + image.size] = image.reshape(-1)
+
+    def commit(self):
+        self._packed.flush()
+        del self._packed
+        if self.size == 0:
+            os.remove(self.temp_path)
+            return
+        self.cache.add_file(self.key, self.temp_path)
+        index = {"key": self.key, "dtype": "uint8", "size": self.size, "images": self.entries}
+        _atomic_write(self.index_path, json.dumps(index).encode("utf-8"))
+
+    def discard(self):
+        self._packed = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def _load_image_pack(cache_folder, cache, key):
+    """Memory-map the image pack if it matches `key` and is still in the blob cache.
+
+    Returns one NxHxWx3 array when every image has the same shape, otherwise a list
+    of per-image arrays, or None when there is no usable pack.
+    """
+    pack_path = cache.path(key)
+    try:
+        with open(os.path.join(cache_folder, f"{IMAGE_PACK_NAME}.json"), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        usable = index.get("key") == key and os.path.getsize(pack_path) == index["size"] and index["size"] > 0
+    except (OSError, ValueError, KeyError):
+        usable = False
+    _count("image_pack_hits" if usable else "image_pack_misses")
+    if not usable:
+        return None
+    cache.touch(key)
+
+    # Copy-on-write keeps the mapping writable for torch without touching the file.
+    packed = np.memmap(pack_path, dtype=np.uint8, mode="c")
+    shapes = {tuple(entry["shape"]) for entry in index["images"]}
+    if len(shapes) == 1:
+        return packed.reshape((len(index["images"]),) + shapes.pop())
+    return [
+        packed[entry["offset"]:entry["offset"] + int(np.prod(entry["shape"]))].reshape(entry["shape"])
+        for entry in index["images"]
+    ]
+
+
+def _start_image_pack(cache_folder, cache, key, sizes):
+    try:
+        return ImagePackWriter(cache_folder, cache, key, sizes)
+    except OSError as e:
+        logging.warning(f"Not packing the decoded images: {e}")
+        return None
+
+
+def _lora_file_name(base_name, compression="none"):
+    return f"{base_name}.safetensors{COMPRESSION_SUFFIXES.get(compression, '')}"
+
+
+def _file_compression(name):
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if name.lower().endswith(suffix):
+            return compression
+    return "none"
+
+
+def _strip_compression(name):
+    return name[:len(name) - len(COMPRESSION_SUFFIXES.get(_file_compression(name), ""))]
+
+
+def _check_compression(compression):
+    if compression == "zstd" and zstandard is None:
+        raise RuntimeError("zstd compression needs the zstandard package: pip install zstandard")
+
+
+def _downcast_lora(lora, save_dtype="keep"):
+    """Cast float tensors wider than `save_dtype` down to it.
+
+    Returns the tensors and the safetensors metadata recording each cast tensor's
+    original dtype, so loading can restore it.
+    """
+    dtype = SAVE_DTYPES[save_dtype]
+    if dtype is None:
+        return lora, None
+    # torch.dtype.itemsize needs torch 2.1.
+    itemsize = torch.empty((), dtype=dtype).element_size()
+    tensors = {}
+    original_dtypes = {}
+    for key, value in lora.items():
+        if value.is_floating_point() and value.element_size() > itemsize:
+            original_dtypes[key] = str(value.dtype).removeprefix("torch.")
+            value = value.to(dtype)
+        tensors[key] = value
+    if not original_dtypes:
+        return tensors, None
+    return tensors, {ORIGINAL_DTYPES_KEY: json.dumps(original_dtypes)}
+
+
+def _restore_lora_dtypes(lora, metadata):
+    original_dtypes = json.loads((metadata or {}).get(ORIGINAL_DTYPES_KEY, "{}"))
+    for key, dtype_name in original_dtypes.items():
+        if key in lora:
+            lora[key] = lora[key].to(getattr(torch, dtype_name))
+    return lora
+
+
+def _compress(data, compression):
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3, threads=-1).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _save_lora_file(lora, local_path, save_dtype="keep", compression="none"):
+    with _stage("serialize"):
+        tensors, metadata = _downcast_lora(lora, save_dtype)
+        if compression == "none":
+            safetensors.torch.save_file(tensors, local_path, metadata)
+            return
+        data = safetensors.torch.save(tensors, metadata)
+        del tensors
+        with open(local_path, "wb") as f:
+            f.write(_compress(data, compression))
+
+
+class _SafetensorsStream(RawIOBase):
+    """Seekable, read-only safetensors serialization of a tensor dict.
+
+    Bytes are produced tensor by tensor straight from the tensors' memory, so an
+    upload can read the file without it ever existing on disk or as one buffer.
+    """
+
+    def __init__(self, tensors, metadata=None):
+        super().__init__()
+        header = {}
+        parts = []
+        offset = 0
+        for name in sorted(tensors):
+            tensor = tensors[name].detach().to("cpu").contiguous()
+            data = memoryview(tensor.reshape(-1).view(torch.uint8).numpy())
+            header[name] = {
+                "dtype": SAFETENSORS_DTYPES[tensor.dtype],
+                "shape": list(tensor.shape),
+                "data_offsets": [offset, offset + len(data)],
+            }
+            parts.append(data)
+            offset += len(data)
+        if metadata:
+            header["__metadata__"] = metadata
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        header_bytes += b" " * (-len(header_bytes) % 8)
+        self._parts = [memoryview(struct.pack("<Q", len(header_bytes)) + header_bytes)] + parts
+        self._starts = []
+        position = 0
+        for part in self._parts:
+            self._starts.append(position)
+            position += len(part)
+        self.size = position
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast("B")
+        written = 0
+        while written < len(buffer) and self._position < self.size:
+            index = bisect.bisect_right(self._starts, self._position) - 1
+            part = self._parts[index][self._position - self._starts[index]:]
+            count = min(len(part), len(buffer) - written)
+            buffer[written:written + count] = part[:count]
+            written += count
+            self._position += count
+        return written
+
+
+def _lora_stream(lora, save_dtype="keep", compression="none"):
+    """Serialize a LoRA for upload without touching the disk."""
+    with _stage("serialize"):
+        tensors, metadata = _downcast_lora(lora, save_dtype)
+        if compression == "none":
+            return _SafetensorsStream(tensors, metadata)
+        return BytesIO(_compress(safetensors.torch.save(tensors, metadata), compression))
+
+
+def _own_copy_pattern(filename):
+    """Pattern of the save node's own names for `filename`; group 2 is the counter.
+
+    Matches `{filename}_00001_` and `{filename}_500_steps_00001_` with any compression
+    suffix, but not the names of `{filename}_style`.
+    """
+    suffixes = "|".join(re.escape(suffix) for suffix in COMPRESSION_SUFFIXES.values())
+    return re.compile(rf"{re.escape(filename)}_(\d+_steps_)?(\d{{5,}})_\.safetensors({suffixes})?")
+
+
+def _next_counter(names, filename, counter=1):
+    """First counter from `counter` on that is above every counter `names` use for `filename`."""
+    own_copy = _own_copy_pattern(filename)
+    for name in names:
+        match = own_copy.fullmatch(name)
+        if match:
+            counter = max(counter, int(match.group(2)) + 1)
+    return counter
+
+
+def _prune_local_copies(folder, filename, max_copies, skip=()):
+    """Delete the oldest local LoRA copies saved as `filename`, keeping `max_copies`.
+
+    Only the save node's own names (`{filename}_00001_`, `{filename}_500_steps_00001_`)
+    count, so `lora` never touches the copies of `lora_style`. Copies whose upload is
+    still queued, running or interrupted are never deleted.
+    """
+    if max_copies <= 0:
+        return
+    own_copy = _own_copy_pattern(filename)
+    copies = []
+    for name in os.listdir(folder):
+        path = os.path.abspath(os.path.join(folder, name))
+        if own_copy.fullmatch(name):
+            copies.append((os.path.getmtime(path), path))
+    copies.sort()
+    for mtime, path in copies[:max(0, len(copies) - max_copies)]:
+        if path in skip or os.path.exists(_upload_state_path(path)):
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"Could not remove old local LoRA copy {path}: {e}")
+
+
+def _decompress_file(source_path, path, compression):
+    _check_compression(compression)
+    with open(path, "wb") as f, _stage("decompress"):
+        if compression == "zstd":
+            with open(source_path, "rb") as source:
+                zstandard.ZstdDecompressor().copy_stream(source, f)
+        else:
+            with gzip.open(source_path, "rb") as source:
+                shutil.copyfileobj(source, f, DOWNLOAD_CHUNK_SIZE)
+
+
+def _load_lora_file(path, name):
+    with _stage("load_lora_file"):
+        if name.lower().endswith(".safetensors"):
+            # Memory-mapped: tensors are paged in from the cached file as they are used.
+            lora = safetensors.torch.load_file(path)
+            with safetensors.safe_open(path, framework="pt") as f:
+                return _restore_lora_dtypes(lora, f.metadata())
+        return comfy.utils.load_torch_file(path, safe_load=True)
+
+
+def _upload_state_path(local_path):
+    state_dir = os.path.join(folder_paths.get_output_directory(), UPLOAD_STATE_DIR)
+    os.makedirs(state_dir, exist_ok=True)
+    digest = hashlib.sha1(os.path.abspath(local_path).encode("utf-8")).hexdigest()
+    return os.path.join(state_dir, f"{digest}.json")
+
+
+def _query_upload_progress(request, size):
+    """Ask Drive how much of a resumable session it has committed.
+
+    Returns `(progress, response)`: the committed byte count and the created file
+    when the upload already finished, or `(None, None)` when the session expired.
+    """
+    headers = {"Content-Range": f"bytes */{size}", "content-length": "0"}
+    resp, content = request.http.request(request.resumable_uri, "PUT", headers=headers)
+    if resp.status in (200, 201):
+        return size, json.loads(content)
+    if resp.status == 308:
+        if "range" in resp:
+            return int(resp["range"].split("-")[1]) + 1, None
+        return 0, None
+    if resp.status in (404, 410):
+        return None, None
+    raise HttpError(resp, content, uri=request.resumable_uri)
+
+
+def _resumable_upload(drive_service, local_path, file_metadata, chunk_size, max_retries=5):
+    """Upload `local_path` in chunks, resuming a session saved by an earlier attempt.
+
+    The session URI is stored next to the output folder as soon as Drive hands it
+    out, so an upload interrupted by a crash or restart continues from the last
+    committed byte. Each chunk is retried with exponential backoff.
+    """
+    stat = os.stat(local_path)
+    state_path = _upload_state_path(local_path)
+    media = MediaFileUpload(
+        local_path, mimetype="application/octet-stream", chunksize=chunk_size, resumable=True
+    )
+    request = drive_service.files().create(body=file_metadata, media_body=media, fields="id")
+
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = None
+    if state and state.get("size") == stat.st_size and state.get("mtime") == stat.st_mtime \
+            and state.get("metadata") == file_metadata:
+        request.resumable_uri = state["resumable_uri"]
+        progress, response = _with_retries(
+            lambda: _query_upload_progress(request, stat.st_size),
+            max_retries,
+            f"Upload status query for {file_metadata['name']}",
+        )
+        if response is not None:
+            os.remove(state_path)
+            return response
+        if progress is None:
+            logging.info(f"Upload session for {file_metadata['name']} expired, starting over")
+            request.resumable_uri = None
+        else:
+            logging.info(
+                f"Resuming upload of {file_metadata['name']} at {progress} of {stat.st_size} bytes"
+            )
+            request.resumable_progress = progress
+
+    def save_session(resumable_uri):
+        state = {
+            "resumable_uri": resumable_uri,
+            "local_path": os.path.abspath(local_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "metadata": file_metadata,
+        }
+        _atomic_write(state_path, json.dumps(state).encode("utf-8"))
+
+    response = _upload_chunks(request, file_metadata, max_retries, save_session)
+
+    try:
+        os.remove(state_path)
+    except FileNotFoundError:
+        pass
+    return response
+
+
+def _upload_stream(drive_service, stream, file_metadata, chunk_size, max_retries=5):
+    """Resumable chunked upload of a seekable stream, without a local file.
+
+    Failed chunks are retried and re-read from the stream, but since nothing is
+    stored on disk the upload can't be resumed after a restart.
+    """
+    media = MediaIoBaseUpload(
+        stream, mimetype="application/octet-stream", chunksize=chunk_size, resumable=True
+    )
+    request = drive_service.files().create(body=file_metadata, media_body=media, fields="id")
+    return _upload_chunks(request, file_metadata, max_retries)
+
+
+def _upload_chunks(request, file_metadata, max_retries=5, on_session=None):
+    """Send a resumable upload request chunk by chunk, retrying each chunk.
+
+    `on_session(resumable_uri)` is called whenever Drive hands out a new session.
+    """
+    def next_chunk():
+        try:
+            return request.next_chunk()
+        except HttpError as e:
+            if e.resp.status in (404, 410) and request.resumable_uri is not None:
+                # The session expired mid-upload; start a new one on the next attempt.
+                request.resumable_uri = None
+                request.resumable_progress = 0
+                raise TransferError(f"Upload session expired: {e}")
+            raise
+
+    response = None
+    saved_uri = None
+    start = request.resumable_progress
+    with _stage("upload"):
+        while response is None:
+            status, response = _with_retries(
+                next_chunk, max_retries, f"Upload of {file_metadata['name']}"
+            )
+            if response is None and on_session is not None and request.resumable_uri \
+                    and request.resumable_uri != saved_uri:
+                saved_uri = request.resumable_uri
+                on_session(saved_uri)
+    _count("bytes_uploaded", request.resumable.size() - start)
+    _count("files_uploaded")
+    return response
+
+
+def _upload_bytes(drive_service, data, file_metadata, mimetype, file_id=None):
+    media = MediaIoBaseUpload(BytesIO(data), mimetype=mimetype)
+    with _stage("upload"):
+        if file_id is not None:
+            response = drive_service.files().update(fileId=file_id, media_body=media, fields="id").execute()
+        else:
+            response = drive_service.files().create(body=file_metadata, media_body=media, fields="id").execute()
+    _count("bytes_uploaded", len(data))
+    _count("files_uploaded")
+    return response
+
+
+def _resume_pending_uploads(drive_service, chunk_size, max_retries=5, skip=()):
+    """Finish uploads left behind by an interrupted run, e.g. before a ComfyUI restart.
+
+    Uploads of the local paths in `skip` are in progress elsewhere and left alone.
+    """
+    state_dir = os.path.join(folder_paths.get_output_directory(), UPLOAD_STATE_DIR)
+    if not os.path.isdir(state_dir):
+        return
+    for filename in sorted(os.listdir(state_dir)):
+        if not filename.endswith(".json"):
+            continue
+        state_path = os.path.join(state_dir, filename)
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if state["local_path"] in skip:
+            continue
+        if not os.path.exists(state["local_path"]):
+            os.remove(state_path)
+            continue
+        try:
+            _resumable_upload(
+                drive_service, state["local_path"], state["metadata"], chunk_size, max_retries
+            )
+            logging.info(f"Finished interrupted upload of {state['metadata']['name']}")
+        except Exception as e:
+            logging.warning(f"Could not resume upload of {state['metadata']['name']}: {e}")
+
+
+class LoraUploadQueue:
+    """Process-wide background uploader for LoRA checkpoints.
+
+    `submit` snapshots the tensors to CPU and returns once the job is queued. Worker
+    threads write the file and run the resumable upload, up to `max_concurrent` at
+    a time. The queue is bounded, so a node blocks only when uploads fall
+    `UPLOAD_QUEUE_SIZE` checkpoints behind.
+    """
+
+    def __init__(self, max_concurrent=2, max_queued=UPLOAD_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._workers = []
+        self._next_id = 0
+        self._resumed_pending = False
+        # Upload slots: a worker that has taken a job waits for one before running it.
+        self._slots = threading.Condition()
+        self._max_concurrent = 0
+        self._running = 0
+        self._waiting = set()
+        self.set_concurrency(max_concurrent)
+
+    def set_concurrency(self, max_concurrent):
+        # Threads are only ever added, so the slot count, not the thread count,
+        # is what limits uploads after the setting is lowered.
+        with self._slots:
+            self._max_concurrent = max_concurrent
+            self._slots.notify_all()
+        with self._lock:
+            while len(self._workers) < max_concurrent:
+                worker = threading.Thread(
+                    target=self._work, name=f"gdrive-lora-upload-{len(self._workers)}", daemon=True
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, lora, local_path, client, file_metadata, chunk_size, max_retries=5,
+               save_dtype="keep", compression="none", on_uploaded=None):
+        """Queue an upload. With `local_path` None the LoRA is uploaded from memory."""
+        snapshot = {k: v.detach().to("cpu", copy=True).contiguous() for k, v in lora.items()}
+        if local_path is not None:
+            # Reserve the file name so the next checkpoint's counter doesn't reuse it.
+            open(local_path, "ab").close()
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            self._jobs[job_id] = {
+                "name": file_metadata["name"],
+                "local_path": local_path,
+                "state": "queued",
+                "error": None,
+                "queued_at": time.time(),
+                "finished_at": None,
+            }
+            while len(self._jobs) > UPLOAD_HISTORY:
+                oldest = next(iter(self._jobs))
+                if self._jobs[oldest]["state"] in ("queued", "in_progress"):
+                    break
+                del self._jobs[oldest]
+        self._queue.put((
+            job_id, snapshot, client, file_metadata, chunk_size, max_retries, save_dtype, compression,
+            on_uploaded,
+        ))
+        return job_id
+
+    def active_paths(self):
+        with self._lock:
+            return {
+                os.path.abspath(job["local_path"]) for job in self._jobs.values()
+                if job["state"] in ("queued", "in_progress") and job["local_path"] is not None
+            }
+
+    def status(self):
+        with self._lock:
+            jobs = [dict(job, id=job_id) for job_id, job in self._jobs.items()]
+        counts = Counter(job["state"] for job in jobs)
+        return {
+            "queued": counts["queued"],
+            "in_progress": counts["in_progress"],
+            "done": counts["done"],
+            "failed": counts["failed"],
+            "jobs": jobs,
+        }
+
+    def flush(self):
+        pending = self._queue.unfinished_tasks
+        if pending:
+            logging.info(f"Waiting for {pending} LoRA uploads to Google Drive to finish")
+        self._queue.join()
+
+    def _set_state(self, job_id, state, error=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job["state"] = state
+                job["error"] = error
+                if state in ("done", "failed"):
+                    job["finished_at"] = time.time()
+
+    def _work(self):
+        while True:
+            (job_id, snapshot, client, file_metadata, chunk_size, max_retries,
+             save_dtype, compression, on_uploaded) = self._queue.get()
+            self._acquire_slot(job_id)
+            local_path = self._jobs[job_id]["local_path"]
+            stream = None
+            try:
+                self._set_state(job_id, "in_progress")
+                with _metered("LoraUploadQueue"):
+                    if local_path is None:
+                        stream = _lora_stream(snapshot, save_dtype, compression)
+                    else:
+                        _save_lora_file(snapshot, local_path, save_dtype, compression)
+                    del snapshot
+                    with client.borrow() as drive_service:
+                        if not self._resumed_pending:
+                            self._resumed_pending = True
+                            _resume_pending_uploads(
+                                drive_service, chunk_size, max_retries, skip=self.active_paths()
+                            )
+                        if local_path is None:
+                            _upload_stream(drive_service, stream, file_metadata, chunk_size, max_retries)
+                        else:
+                            _resumable_upload(
+                                drive_service, local_path, file_metadata, chunk_size, max_retries
+                            )
+                self._set_state(job_id, "done")
+                if on_uploaded is not None:
+                    on_uploaded()
+                logging.info(f"Uploaded {file_metadata['name']} to Google Drive")
+            except Exception as e:
+                self._set_state(job_id, "failed", str(e))
+                logging.error(f"Background upload of {file_metadata['name']} failed: {e}")
+            finally:
+                # Don't keep the serialized tensors alive while waiting for the next job.
+                stream = None
+                self._release_slot()
+                self._queue.task_done()
+
+    def _acquire_slot(self, job_id):
+        with self._slots:
+            # Oldest job first, so waiting for a slot doesn't reorder the uploads.
+            self._waiting.add(job_id)
+            while self._running >= self._max_concurrent or job_id != min(self._waiting):
+                self._slots.wait()
+            self._waiting.remove(job_id)
+            self._running += 1
+            self._slots.notify_all()
+
+    def _release_slot(self):
+        with self._slots:
+            self._running -= 1
+            self._slots.notify_all()
+
+
+_upload_queue = None
+_upload_queue_lock = threading.Lock()
+_saved_names = set()
+_saved_names_lock = threading.Lock()
+
+
+def _get_upload_queue(max_concurrent=None):
+    global _upload_queue
+    with _upload_queue_lock:
+        if _upload_queue is None:
+            _upload_queue = LoraUploadQueue(max_concurrent or 2)
+            atexit.register(_upload_queue.flush)
+        elif max_concurrent:
+            _upload_queue.set_concurrency(max_concurrent)
+    return _upload_queue
+
+
+def _upload_status():
+    if _upload_queue is None:
+        return {"queued": 0, "in_progress": 0, "done": 0, "failed": 0, "jobs": []}
+    return _upload_queue.status()
+
+
+try:
+    from aiohttp import web
+    from server import PromptServer
+
+    @PromptServer.instance.routes.get("/cheap_trainer_utils/uploads")
+    async def _upload_status_route(request):
+        return web.json_response(_upload_status())
+except (ImportError, AttributeError):
+    pass
+
+
+class LoraStateCache:
+    """LRU cache of loaded LoRA state dicts, bounded by the total tensor size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total = 0
+
+    def resize(self, max_bytes):
+        """Change the budget, evicting least recently used entries that no longer fit."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key) if self.max_bytes > 0 else None
+            if entry is None:
+                _count("lora_ram_cache_misses")
+                return None
+            self._entries.move_to_end(key)
+        _count("lora_ram_cache_hits")
+        return entry[0]
+
+    def put(self, key, state_dict):
+        size = sum(t.nbytes for t in state_dict.values() if isinstance(t, torch.Tensor))
+        with self._lock:
+            if key in self._entries:
+                self._total -= self._entries.pop(key)[1]
+            if size <= self.max_bytes:
+                self._entries[key] = (state_dict, size)
+                self._total += size
+            self._evict()
+
+    def _evict(self):
+        while self._total > self.max_bytes:
+            evicted_key, (evicted, evicted_size) = self._entries.popitem(last=False)
+            self._total -= evicted_size
+
+
+_lora_state_cache = LoraStateCache(0)
+_lora_lookups = {}
+_lora_lookups_lock = threading.Lock()
+
+
+def _lookup_lora_file(credentials_json, folder_id, lora_name, max_age=LORA_LOOKUP_TTL, max_retries=5):
+    """Find a LoRA on Drive, reusing a lookup made less than `max_age` seconds ago.
+
+    IS_CHANGED runs right before load_lora for every queued prompt, so sharing the
+    lookup means a strength sweep only talks to Drive once per prompt at most.
+    """
+    client = _service_account_client(credentials_json)
+    lookup_key = (id(client), folder_id, lora_name)
+    with _lora_lookups_lock:
+        cached = _lora_lookups.get(lookup_key)
+    if cached is not None and time.monotonic() - cached[0] < max_age:
+        _count("lora_lookup_cache_hits")
+        return cached[1]
+    _count("lora_lookup_cache_misses")
+
+    def attempt():
+        client.check_folder(folder_id)
+        with client.borrow() as drive_service, _stage("lookup"):
+            return _find_file(drive_service, folder_id, lora_name)
+
+    lora_file = _with_retries(attempt, max_retries, f"Lookup of {lora_name}")
+    if lora_file is None:
+        raise ValueError(f"LoRA file '{lora_name}' not found in Google Drive folder {folder_id}")
+    with _lora_lookups_lock:
+        _lora_lookups[lookup_key] = (time.monotonic(), lora_file)
+    return lora_file
+
+
+class GoogleDriveDataset:
+    """Lazy handle over image-caption pairs that live in the local blob cache.
+
+    Iterating yields `(images, conditioning)` batches of at most `batch_size` pairs,
+    where every batch shares one image size (one aspect ratio bucket). Pairs with
+    repeats are scheduled that many times but read from the same cached files. Images are
+    decoded per batch and the next batch is prepared in the background while the
+    current one is used, so memory depends on the batch size, not the dataset size.
+    """
+
+    def __init__(self, pairs, clip, cache, fetch, batch_size, resolution=0, bucket_mode="off",
+                 repeats=None, image_dtype="float32", pin_memory=False):
+        self.pairs = pairs
+        self.clip = clip
+        self.cache = cache
+        self.batch_size = batch_size
+        self.resolution = resolution
+        self.bucket_mode = bucket_mode
+        self.image_dtype = image_dtype
+        self.pin_memory = pin_memory
+        self._fetch = fetch
+
+        keys = [_blob_key(f) for name, image_file, caption_file in pairs for f in (image_file, caption_file)]
+        cache.pin(keys)
+        self._finalizer = weakref.finalize(self, cache.unpin, keys)
+
+        # Bucket assignment only needs the image headers, not decoded pixels.
+        groups = {}
+        for index, (name, image_file, caption_file) in enumerate(pairs):
+            groups.setdefault(self._output_size(image_file), []).append(index)
+        self.buckets = sorted(groups.items())
+        self.repeats = list(repeats) if repeats is not None else [1] * len(pairs)
+        self.batches = []
+        self.batch_sizes = []
+        for size, indices in self.buckets:
+            indices = _repeat_indices(indices, self.repeats)
+            for start in range(0, len(indices), batch_size):
+                self.batches.append(indices[start:start + batch_size])
+                self.batch_sizes.append(size)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as decode_pool:
+            return self._load_batch(index, decode_pool)
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as decode_pool, \
+                ThreadPoolExecutor(max_workers=1) as prefetcher:
+            pending = None
+            if self.batches:
+                pending = prefetcher.submit(self._load_batch, 0, decode_pool)
+            for position in range(len(self.batches)):
+                batch = pending.result()
+                if position + 1 < len(self.batches):
+                    pending = prefetcher.submit(self._load_batch, position + 1, decode_pool)
+                yield batch
+
+    def description(self):
+        """The IMAGE_BUCKETS description, in the same form as the non-streaming loaders output."""
+        names = []
+        repeats = []
+        buckets = []
+        for (width, height), indices in self.buckets:
+            start = len(names)
+            names.extend(self.pairs[index][0] for index in indices)
+            repeats.extend(self.repeats[index] for index in indices)
+            buckets.append({
+                "width": width,
+                "height": height,
+                "indices": _repeat_indices(range(start, start + len(indices)), repeats),
+            })
+        return {"names": names, "repeats": repeats, "buckets": buckets}
+
+    def close(self):
+        self._finalizer()
+
+    def _output_size(self, image_file):
+        path = self.cache.path(_blob_key(image_file))
+        if not os.path.exists(path):
+            self._fetch(image_file)
+        return _image_size(path, self.resolution, self.bucket_mode)
+
+    def _load_pair(self, index):
+        name, image_file, caption_file = self.pairs[index]
+        image = _decode_image(self._fetch(image_file), self.resolution, self.bucket_mode)
+        caption_text = _decode_pair_file(caption_file, self._fetch(caption_file))
+        return image, caption_text
+
+    def _load_batch(self, position, decode_pool):
+        batch = self.batches[position]
+        # A repeated pair can land in a batch more than once; decode it once.
+        unique = list(dict.fromkeys(batch))
+        decoded = dict(zip(unique, decode_pool.map(self._load_pair, unique)))
+        image_batch = ImageBatch(
+            [self.batch_sizes[position]] * len(batch), self.image_dtype, self.pin_memory
+        )
+        for slot, index in enumerate(batch):
+            image_batch.write(slot, decoded[index][0])
+        images = image_batch.tensors[0]
+        conditioning = _encode_captions(self.clip, [decoded[index][1] for index in batch])
+        return images, conditioning
+
+
+def _load_prefetch_config():
+    """Read the datasets to prefetch from the config file and environment variables.
+
+    Returns None when no folders are configured.
+    """
+    path = os.environ.get(PREFETCH_CONFIG_ENV) or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), PREFETCH_CONFIG_NAME
+    )
+    config = {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable prefetch config {path}: {e}")
+
+    folders = config.get("folders", []) if isinstance(config, dict) else None
+    if not isinstance(folders, list) or not all(isinstance(f, str) for f in folders):
+        raise ValueError(f'Prefetch config {path} needs "folders" to be a list of Drive folder IDs')
+    folders = [f.strip() for f in folders if f.strip()]
+    folders.extend(f.strip() for f in os.environ.get(PREFETCH_FOLDERS_ENV, "").split(",") if f.strip())
+    if not folders:
+        return None
+    credentials_json = os.environ.get(PREFETCH_CREDENTIALS_ENV) or config.get("credentials_json")
+    if not credentials_json:
+        logging.warning("Dataset prefetch is configured without credentials_json, skipping it")
+        return None
+    if not credentials_json.lstrip().startswith("{"):
+        # A path to the service account key file rather than its content.
+        with open(os.path.expanduser(credentials_json), 'r', encoding='utf-8') as f:
+            credentials_json = f.read()
+    return dict(config, folders=list(dict.fromkeys(folders)), credentials_json=credentials_json)
+
+
+class DatasetPrefetcher:
+    """Fills the blob cache with configured dataset folders in the background.
+
+    Started at import, so datasets download while ComfyUI boots and models load.
+    Everything goes through the blob cache, so a cached loader node running later
+    (or at the same time) reads the files that have arrived and waits for the ones
+    in flight instead of downloading them again.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._thread = threading.Thread(target=self._run, name="gdrive-dataset-prefetch", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        cache = _get_blob_cache(self.config.get("cache_max_gb"))
+        client = _service_account_client(self.config["credentials_json"])
+        for folder_id in self.config["folders"]:
+            try:
+                with _metered("DatasetPrefetcher"):
+                    self._prefetch(client, cache, folder_id)
+            except Exception as e:
+                logging.warning(f"Prefetch of Google Drive folder {folder_id} failed: {e}")
+
+    def _prefetch(self, client, cache, folder_id):
+        max_retries = self.config.get("max_retries", 5)
+        cache_folder = os.path.join(folder_paths.get_input_directory(), GDRIVE_CACHE_DIR, folder_id)
+        remote_files = _sync_folder(
+            client, folder_id, cache_folder, cache, max_retries, self.config.get("recursive", True)
+        )
+        files = [
+            f for name, image_file, caption_file in _pair_files(remote_files)
+            for f in (image_file, caption_file)
+        ]
+        missing = [f for f in files if _blob_key(f) not in cache]
+        with cache.pinned(_blob_key(f) for f in files):
+            _download_files(
+                client, missing, lambda file_info, data: None,
+                self.config.get("download_workers", 8), max_retries, cache=cache,
+            )
+        logging.info(
+            f"Prefetched Google Drive folder {folder_id}: {len(missing)} files downloaded, "
+            f"{len(files) - len(missing)} already cached"
+        )
+
+
+_prefetcher = None
+
+
+def _start_prefetch():
+    global _prefetcher
+    try:
+        config = _load_prefetch_config()
+    except Exception as e:
+        logging.warning(f"Could not read the dataset prefetch configuration: {e}")
+        return
+    if config is not None:
+        _prefetcher = DatasetPrefetcher(config)
+        _prefetcher.start()
+
 
 class SaveLoratoGoogleDrive:
     def __init__(self):
@@ -77,6 +2592,70 @@ class SaveLoratoGoogleDrive:
                         "tooltip": "Optional: The number of steps to LoRA has been trained for, used to name the saved file.",
                     },
                 ),
+                "chunk_size_mb": (
+                    "INT",
+                    {
+                        "default": 8,
+                        "min": 1,
+                        "max": 1024,
+                        "tooltip": "Size of each resumable upload chunk in MB. An interrupted upload continues from the last completed chunk.",
+                    },
+                ),
+                "max_retries": (
+                    "INT",
+                    {
+                        "default": 5,
+                        "min": 0,
+                        "max": 20,
+                        "tooltip": "How many times a failed chunk is retried, with exponential backoff.",
+                    },
+                ),
+                "upload_mode": (
+                    UPLOAD_MODES,
+                    {
+                        "default": "background",
+                        "tooltip": "background: queue the upload and return right away so training continues. blocking: wait until the upload has finished.",
+                    },
+                ),
+                "max_concurrent_uploads": (
+                    "INT",
+                    {
+                        "default": 2,
+                        "min": 1,
+                        "max": 16,
+                        "tooltip": "How many background uploads may run at the same time.",
+                    },
+                ),
+                "save_dtype": (
+                    list(SAVE_DTYPES),
+                    {
+                        "default": "keep",
+                        "tooltip": "Cast fp32 weights to fp16 or bf16 before saving, halving the upload. The original dtype is restored when the LoRA is loaded from Google Drive.",
+                    },
+                ),
+                "compression": (
+                    COMPRESSION_MODES,
+                    {
+                        "default": "none",
+                        "tooltip": "Lossless compression of the uploaded file (.safetensors.zst or .safetensors.gz). zstd needs the zstandard package.",
+                    },
+                ),
+                "keep_local_copy": (
+                    "BOOLEAN",
+                    {
+                        "default": True,
+                        "tooltip": "Write the LoRA to the output folder before uploading. When off, it is uploaded straight from memory and never touches the disk, but an interrupted upload can't be resumed after a restart.",
+                    },
+                ),
+                "max_local_copies": (
+                    "INT",
+                    {
+                        "default": 0,
+                        "min": 0,
+                        "max": 10000,
+                        "tooltip": "Keep only this many local copies with this prefix, deleting the oldest after each successful upload. 0 keeps all.",
+                    },
+                ),
             },
         }
 
@@ -86,8 +2665,11 @@ class SaveLoratoGoogleDrive:
     EXPERIMENTAL = True
     OUTPUT_NODE = True
 
+    @_instrumented
     def googledrivelorasave(
-        self, lora, prefix, client_id, client_secret, refresh_token, folder_id, steps=None
+        self, lora, prefix, client_id, client_secret, refresh_token, folder_id, steps=None,
+        chunk_size_mb=8, max_retries=5, upload_mode="background", max_concurrent_uploads=2,
+        save_dtype="keep", compression="none", keep_local_copy=True, max_local_copies=0,
     ):
         if not folder_id or len(folder_id.strip()) < 10:
             raise ValueError(
@@ -99,43 +2681,61 @@ class SaveLoratoGoogleDrive:
             folder_paths.get_save_image_path(prefix, self.gdrive_saved_dir)
         )
 
-        credentials = Credentials(
-            token=None,
-            refresh_token=refresh_token.strip(),
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=client_id.strip(),
-            client_secret=client_secret.strip(),
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-
-        credentials.refresh(Request())
-
-        drive_service = build("drive", "v3", credentials=credentials, cache_discovery=False)
+        _check_compression(compression)
+
+        client = _oauth_client(client_id, client_secret, refresh_token)
+        client.refresh_if_needed()
+        client.check_folder(folder_id)
+
+        def checkpoint_name(counter):
+            if steps is None:
+                return _lora_file_name(f"{filename}_{counter:05}_", compression)
+            return _lora_file_name(f"{filename}_{steps}_steps_{counter:05}_", compression)
+
+        # The local counter only sees local copies: also move past every name already
+        # in the folder (streamed uploads leave no local file, also across restarts)
+        # and every upload of this process that hasn't reached Drive yet.
+        remote_names = [f["name"] for f in _list_tree(client, folder_id, recursive=False, max_retries=max_retries)]
+        counter = _next_counter(remote_names, filename, counter)
+        with _saved_names_lock:
+            while checkpoint_name(counter) in _saved_names:
+                counter += 1
+            output_checkpoint = checkpoint_name(counter)
+            _saved_names.add(output_checkpoint)
+        local_path = os.path.join(full_output_folder, output_checkpoint) if keep_local_copy else None
+        file_metadata = {"name": output_checkpoint, "parents": [folder_id]}
 
-        try:
-            folder_info = drive_service.files().get(
-                fileId=folder_id,
-                fields='id,name,mimeType'
-            ).execute()
-        except Exception as e:
-            raise ValueError(f"Cannot access folder {folder_id}: {e}")
+        chunk_size = chunk_size_mb * 1024 * 1024
+        prune = None
+        if keep_local_copy and max_local_copies > 0:
+            prune = lambda: _prune_local_copies(
+                full_output_folder, filename, max_local_copies,
+                skip=_upload_queue.active_paths() if _upload_queue is not None else (),
+            )
 
-        if steps is None:
-            output_checkpoint = f"{filename}_{counter:05}_.safetensors"
-        else:
-            output_checkpoint = f"{filename}_{steps}_steps_{counter:05}_.safetensors"
+        if upload_mode == "background":
+            upload_queue = _get_upload_queue(max_concurrent_uploads)
+            upload_queue.submit(
+                lora, local_path, client, file_metadata, chunk_size, max_retries, save_dtype, compression,
+                on_uploaded=prune,
+            )
+            return {}
 
-        local_path = os.path.join(full_output_folder, output_checkpoint)
-        file_metadata = {"name": output_checkpoint, "parents": [folder_id]}
+        active = _upload_queue.active_paths() if _upload_queue is not None else ()
+        if local_path is None:
+            stream = _lora_stream(lora, save_dtype, compression)
+            with client.borrow() as drive_service:
+                _resume_pending_uploads(drive_service, chunk_size, max_retries, skip=active)
+                _upload_stream(drive_service, stream, file_metadata, chunk_size, max_retries)
+            return {}
 
-        safetensors.torch.save_file(lora, local_path)
+        _save_lora_file(lora, local_path, save_dtype, compression)
 
-        media = MediaFileUpload(local_path, mimetype="application/octet-stream")
-        file = (
-            drive_service.files()
-            .create(body=file_metadata, media_body=media, fields="id")
-            .execute()
-        )
+        with client.borrow() as drive_service:
+            _resume_pending_uploads(drive_service, chunk_size, max_retries, skip=active)
+            _resumable_upload(drive_service, local_path, file_metadata, chunk_size, max_retries)
+        if prune is not None:
+            prune()
 
         return {}
 
@@ -156,109 +2756,86 @@ class textImagePairFromGoogleDrive:
                 ),
                 "clip": (IO.CLIP, {"tooltip": "The CLIP model used for encoding the text."}),
             },
+            "optional": _dataset_loader_inputs(),
+            "hidden": {"prompt": "PROMPT", "unique_id": "UNIQUE_ID"},
         }
 
-    RETURN_TYPES = ("IMAGE", IO.CONDITIONING)
+    RETURN_TYPES = ("IMAGE", IO.CONDITIONING, "IMAGE_BUCKETS", "IMAGE_BATCHES")
+    OUTPUT_TOOLTIPS = (
+        "The image batch. Only available when every image has the same size.",
+        "The encoded captions, in the same order as the images.",
+        "The pair names, repeat counts and bucket layout.",
+        "A list with one image batch per aspect ratio bucket.",
+    )
     FUNCTION = "textImagePairing"
     CATEGORY = "cheap_trainer_utils"
     EXPERIMENTAL = True
     DESCRIPTION = "Loads a batch of images and captions from Google Drive for training."
 
-    def textImagePairing(self, folder_id, clip, credentials_json):
+    @_instrumented
+    def textImagePairing(self, folder_id, clip, credentials_json, download_workers=8, max_retries=5,
+                         resolution=0, bucket_mode="off", recursive=True, image_dtype="float32",
+                         pin_memory=False, prompt=None, unique_id=None):
         if clip is None:
             raise RuntimeError("ERROR: clip input is invalid: None\n\nIf the clip is from a checkpoint loader node your checkpoint does not contain a valid clip or text encoder model.")
 
-        credentials_dict = json.loads(credentials_json)
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials_dict, scopes=["https://www.googleapis.com/auth/drive"]
-        )
+        client = _service_account_client(credentials_json)
+        client.check_folder(folder_id, fields='id,name,mimeType,capabilities')
 
-        drive_service = build("drive", "v3", credentials=credentials, cache_discovery=False)
+        listing = _list_tree(client, folder_id, recursive, max_retries)
+        pack = _read_pack(listing, lambda f: _fetch_bytes(client, f, max_retries))
+        pairs = _pair_files(_dataset_files(listing, pack))
 
-        try:
-            folder_info = drive_service.files().get(
-                fileId=folder_id,
-                fields='id,name,mimeType,capabilities'
-            ).execute()
-        except Exception as e:
-            raise ValueError(f"Cannot access folder {folder_id}: {e}")
+        if not pairs:
+            raise ValueError("No matching image-caption pairs found in the folder!")
 
-        query = f"'{folder_id}' in parents and trashed=false"
-        results = (
-            drive_service.files()
-            .list(
-                q=query,
-                corpora='user',
-                includeItemsFromAllDrives=False,
-                supportsAllDrives=False,
-                fields="files(id, name, mimeType)",
-                pageSize=1000
+        files = [f for name, image_file, caption_file in pairs for f in (image_file, caption_file)]
+        prefetched = {}
+        if pack is not None:
+            _fetch_from_pack(
+                client, pack, {_blob_key(f) for f in files}, prefetched.__setitem__, max_retries
             )
-            .execute()
+        # With one fixed output size the batch can be allocated before anything is
+        # downloaded, and every image is decoded into its slot as soon as it arrives.
+        fixed_size = resolution > 0 and bucket_mode != "aspect_buckets"
+        if fixed_size:
+            batch = ImageBatch([(resolution, resolution)] * len(pairs), image_dtype, pin_memory)
+            # `process` gets the very file_info objects of `files`.
+            slots = {id(image_file): index for index, (name, image_file, caption_file) in enumerate(pairs)}
+
+        def read_file(file_info, data):
+            if file_info["name"].lower().endswith(".txt"):
+                return _decode_pair_file(file_info, data)
+            if fixed_size:
+                batch.write(slots[id(file_info)], _decode_image(data, resolution, bucket_mode))
+                return None
+            # Image sizes are needed to allocate the batch; keep the bytes until then.
+            return _image_size(data, resolution, bucket_mode), data
+
+        results = _download_files(
+            client, files, read_file, download_workers, max_retries, prefetched=prefetched
+        )
+        prefetched.clear()
+        if not fixed_size:
+            images = results[0::2]
+
+            def decode(index):
+                size, data = images[index]
+                images[index] = None
+                return _decode_image(data, resolution, bucket_mode)
+
+            sizes = [size for size, data in images]
+            _check_image_sizes(sizes, bucket_mode, _linked_outputs(prompt, unique_id))
+            batch = ImageBatch(sizes, image_dtype, pin_memory).fill(decode)
+
+        names = [name for name, image_file, caption_file in pairs]
+        output_images, image_batches, caption_texts, buckets = _assemble_batch(
+            names, batch, results[1::2], [_repeats(name) for name in names]
         )
 
-        files = results.get('files', [])
-        valid_extensions = [".png", ".jpg", ".jpeg", ".webp"]
-        images = {
-            f["name"].rsplit(".", 1)[0]: f
-            for f in files
-            if any(f["name"].lower().endswith(ext) for ext in valid_extensions)
-        }
-        captions = {
-            f["name"].rsplit(".", 1)[0]: f
-            for f in files
-            if f["name"].lower().endswith(".txt")
-        }
-
-        paired_names = sorted(set(images.keys()) & set(captions.keys()))
-
-        if not paired_names:
-            raise ValueError("No matching image-caption pairs found in the folder!")
-
-        output_images = []
-        caption_texts = []
-
-        for pair_name in paired_names:
-            image_file = images[pair_name]
-            caption_file = captions[pair_name]
-
-            image_request = drive_service.files().get_media(fileId=image_file["id"])
-            image_buffer = BytesIO()
-            image_downloader = MediaIoBaseDownload(image_buffer, image_request)
-            done = False
-            while not done:
-                status, done = image_downloader.next_chunk()
-
-            caption_request = drive_service.files().get_media(fileId=caption_file["id"])
-            caption_buffer = BytesIO()
-            caption_downloader = MediaIoBaseDownload(caption_buffer, caption_request)
-            done = False
-            while not done:
-                status, done = caption_downloader.next_chunk()
-
-            image_buffer.seek(0)
-            pil_image = Image.open(image_buffer)
-            pil_image = pil_image.convert("RGB")
-            image_np = np.array(pil_image).astype(np.float32) / 255.0
-            image_tensor = torch.from_numpy(image_np)[None,]
-            output_images.append(image_tensor)
-
-            caption_buffer.seek(0)
-            caption_text = caption_buffer.read().decode("utf-8").strip()
-            caption_texts.append(caption_text)
-
-        output_tensor = torch.cat(output_images, dim=0)
-
-        conditions = []
-        empty_cond = clip.encode_from_tokens_scheduled(clip.tokenize(""))
-        for text in caption_texts:
-            if text == "":
-                conditions.append(empty_cond)
-            else:
-                tokens = clip.tokenize(text)
-                conditions.extend(clip.encode_from_tokens_scheduled(tokens))
+        conditions = _encode_captions(clip, caption_texts)
 
-        return (output_tensor, conditions)
+        return (output_images, conditions, buckets, image_batches)
 
 
 class textImagePairFromGoogleDriveCached:
@@ -277,163 +2854,173 @@ class textImagePairFromGoogleDriveCached:
                 ),
                 "clip": (IO.CLIP, {"tooltip": "The CLIP model used for encoding the text."}),
             },
+            "optional": {
+                **_dataset_loader_inputs(),
+                "cache_max_gb": (
+                    "FLOAT",
+                    {
+                        "default": 20.0,
+                        "min": 0.0,
+                        "max": 10000.0,
+                        "step": 0.5,
+                        "tooltip": "Disk budget of the shared Google Drive cache in GB. Least recently used files are evicted above it. 0 disables the limit.",
+                    },
+                ),
+                "pack_images": (
+                    "BOOLEAN",
+                    {
+                        "default": True,
+                        "tooltip": "Keep a pre-decoded copy of the images on disk so later runs skip image decoding.",
+                    },
+                ),
+                "streaming": (
+                    "BOOLEAN",
+                    {
+                        "default": False,
+                        "tooltip": "Don't load the dataset into memory. Outputs a lazy dataset that decodes one batch at a time from the local cache instead of the image and conditioning batches.",
+                    },
+                ),
+                "stream_batch_size": (
+                    "INT",
+                    {
+                        "default": 4,
+                        "min": 1,
+                        "max": 1024,
+                        "tooltip": "Number of pairs per batch in streaming mode.",
+                    },
+                ),
+            },
+            "hidden": {"prompt": "PROMPT", "unique_id": "UNIQUE_ID"},
         }
 
-    RETURN_TYPES = ("IMAGE", IO.CONDITIONING)
+    RETURN_TYPES = ("IMAGE", IO.CONDITIONING, "IMAGE_BUCKETS", "GDRIVE_DATASET", "IMAGE_BATCHES")
+    OUTPUT_TOOLTIPS = (
+        "The image batch. Only available when every image has the same size, and not in streaming mode.",
+        "The encoded captions, in the same order as the images. Not available in streaming mode.",
+        "The pair names, repeat counts and bucket layout.",
+        "The lazy dataset. Only available in streaming mode.",
+        "A list with one image batch per aspect ratio bucket. Not available in streaming mode.",
+    )
     FUNCTION = "textImagePairing"
     CATEGORY = "cheap_trainer_utils"
     EXPERIMENTAL = True
-    DESCRIPTION = "Loads images and captions from local cache first. If cache doesn't exist, downloads from Google Drive and saves to cache."
+    DESCRIPTION = "Loads images and captions through a local cache that is kept in sync with Google Drive. Only new or changed files are downloaded."
 
-    def textImagePairing(self, folder_id, clip, credentials_json):
+    @_instrumented
+    def textImagePairing(self, folder_id, clip, credentials_json, download_workers=8, max_retries=5,
+                         resolution=0, bucket_mode="off", recursive=True, image_dtype="float32",
+                         pin_memory=False, cache_max_gb=20.0, pack_images=True, streaming=False,
+                         stream_batch_size=4, prompt=None, unique_id=None):
         if clip is None:
             raise RuntimeError("ERROR: clip input is invalid: None\n\nIf the clip is from a checkpoint loader node your checkpoint does not contain a valid clip or text encoder model.")
 
-        cache_base_dir = os.path.join(folder_paths.get_input_directory(), "gdrive_cache")
-        cache_folder = os.path.join(cache_base_dir, folder_id)
-
-        use_cache = os.path.exists(cache_folder) and len(os.listdir(cache_folder)) > 0
-
-        if use_cache:
-            paired_names = []
-            files_in_cache = os.listdir(cache_folder)
-
-            valid_extensions = [".png", ".jpg", ".jpeg", ".webp"]
-            images = {
-                f.rsplit(".", 1)[0]: f
-                for f in files_in_cache
-                if any(f.lower().endswith(ext) for ext in valid_extensions)
-            }
-            captions = {
-                f.rsplit(".", 1)[0]: f
-                for f in files_in_cache
-                if f.lower().endswith(".txt")
-            }
-
-            paired_names = sorted(set(images.keys()) & set(captions.keys()))
+        linked = _linked_outputs(prompt, unique_id)
+        if streaming and linked is not None and linked & {0, 1, 4}:
+            raise ValueError(
+                "In streaming mode only the IMAGE_BUCKETS and GDRIVE_DATASET outputs are available. "
+                "Disconnect IMAGE, CONDITIONING and IMAGE_BATCHES, or turn off streaming."
+            )
+        if not streaming and linked is not None and 3 in linked:
+            raise ValueError("The GDRIVE_DATASET output is only available in streaming mode. Turn on streaming or disconnect it.")
 
-            if not paired_names:
-                use_cache = False
-            else:
-                output_images = []
-                caption_texts = []
+        cache_base_dir = os.path.join(folder_paths.get_input_directory(), GDRIVE_CACHE_DIR)
+        cache_folder = os.path.join(cache_base_dir, folder_id)
+        cache = _get_blob_cache(cache_max_gb)
 
-                for pair_name in paired_names:
-                    image_path = os.path.join(cache_folder, images[pair_name])
-                    pil_image = Image.open(image_path).convert("RGB")
-                    image_np = np.array(pil_image).astype(np.float32) / 255.0
-                    image_tensor = torch.from_numpy(image_np)[None,]
-                    output_images.append(image_tensor)
+        client = _service_account_client(credentials_json)
+        client.check_folder(folder_id, fields='id,name,mimeType,capabilities')
 
-                    caption_path = os.path.join(cache_folder, captions[pair_name])
-                    with open(caption_path, 'r', encoding='utf-8') as f:
-                        caption_text = f.read().strip()
-                    caption_texts.append(caption_text)
+        remote_files = _sync_folder(client, folder_id, cache_folder, cache, max_retries, recursive)
 
-                output_tensor = torch.cat(output_images, dim=0)
+        pairs = _pair_files(remote_files)
 
-        if not use_cache:
-            os.makedirs(cache_folder, exist_ok=True)
+        if not pairs:
+            raise ValueError("No matching image-caption pairs found in the folder!")
 
-            credentials_dict = json.loads(credentials_json)
-            credentials = service_account.Credentials.from_service_account_info(
-                credentials_dict, scopes=["https://www.googleapis.com/auth/drive"]
+        if streaming:
+            return self._stream(
+                pairs, clip, cache, client, download_workers, max_retries,
+                stream_batch_size, resolution, bucket_mode, image_dtype, pin_memory,
             )
 
-            drive_service = build("drive", "v3", credentials=credentials, cache_discovery=False)
+        names = [name for name, image_file, caption_file in pairs]
+        pack_key = _pack_key(
+            [image_file for name, image_file, caption_file in pairs],
+            f"{resolution}:{bucket_mode if resolution > 0 else 'off'}",
+        )
+        # The pack is a blob too; keep it from being evicted while it is mapped or written.
+        with cache.pinned([pack_key]):
+            packed_images = _load_image_pack(cache_folder, cache, pack_key) if pack_images else None
 
-            try:
-                folder_info = drive_service.files().get(
-                    fileId=folder_id,
-                    fields='id,name,mimeType,capabilities'
-                ).execute()
-            except Exception as e:
-                raise ValueError(f"Cannot access folder {folder_id}: {e}")
-
-            query = f"'{folder_id}' in parents and trashed=false"
-            results = (
-                drive_service.files()
-                .list(
-                    q=query,
-                    corpora='user',
-                    includeItemsFromAllDrives=False,
-                    supportsAllDrives=False,
-                    fields="files(id, name, mimeType)",
-                    pageSize=1000
+            if packed_images is not None:
+                # Warm start: only the captions come from the blob cache, images from the pack.
+                files = [caption_file for name, image_file, caption_file in pairs]
+            else:
+                files = [f for name, image_file, caption_file in pairs for f in (image_file, caption_file)]
+            # Images only have their headers read here; they are decoded into the batch below.
+            read_header = partial(_decode_pair_file, resolution=resolution, bucket_mode=bucket_mode)
+            with cache.pinned(_blob_key(f) for f in files):
+                results = _download_files(
+                    client, files, read_header, download_workers, max_retries, cache=cache
                 )
-                .execute()
-            )
-
-            files = results.get('files', [])
-            valid_extensions = [".png", ".jpg", ".jpeg", ".webp"]
-            images = {
-                f["name"].rsplit(".", 1)[0]: f
-                for f in files
-                if any(f["name"].lower().endswith(ext) for ext in valid_extensions)
-            }
-            captions = {
-                f["name"].rsplit(".", 1)[0]: f
-                for f in files
-                if f["name"].lower().endswith(".txt")
-            }
-
-            paired_names = sorted(set(images.keys()) & set(captions.keys()))
-
-            if not paired_names:
-                raise ValueError("No matching image-caption pairs found in the folder!")
-
-            output_images = []
-            caption_texts = []
-
-            for pair_name in paired_names:
-                image_file = images[pair_name]
-                caption_file = captions[pair_name]
-
-                image_request = drive_service.files().get_media(fileId=image_file["id"])
-                image_buffer = BytesIO()
-                image_downloader = MediaIoBaseDownload(image_buffer, image_request)
-                done = False
-                while not done:
-                    status, done = image_downloader.next_chunk()
 
-                caption_request = drive_service.files().get_media(fileId=caption_file["id"])
-                caption_buffer = BytesIO()
-                caption_downloader = MediaIoBaseDownload(caption_buffer, caption_request)
-                done = False
-                while not done:
-                    status, done = caption_downloader.next_chunk()
-
-                image_buffer.seek(0)
-                pil_image = Image.open(image_buffer)
-                pil_image = pil_image.convert("RGB")
-
-                image_cache_path = os.path.join(cache_folder, image_file["name"])
-                pil_image.save(image_cache_path)
+                if packed_images is not None:
+                    caption_texts = results
+                    sizes = [(image.shape[1], image.shape[0]) for image in packed_images]
+                    _check_image_sizes(sizes, bucket_mode, linked)
+                    batch = ImageBatch(sizes, image_dtype, pin_memory).fill(lambda index: packed_images[index])
+                else:
+                    sizes = results[0::2]
+                    caption_texts = results[1::2]
+                    _check_image_sizes(sizes, bucket_mode, linked)
+                    image_paths = [cache.path(_blob_key(image_file)) for name, image_file, caption_file in pairs]
+                    pack = _start_image_pack(cache_folder, cache, pack_key, sizes) if pack_images else None
+                    try:
+                        batch = ImageBatch(sizes, image_dtype, pin_memory).fill(
+                            lambda index: _decode_image(image_paths[index], resolution, bucket_mode), pack
+                        )
+                    except BaseException:
+                        if pack is not None:
+                            pack.discard()
+                        raise
+                    if pack is not None:
+                        pack.commit()
+
+        output_images, image_batches, caption_texts, buckets = _assemble_batch(
+            names, batch, caption_texts, [_repeats(name) for name in names]
+        )
 
-                image_np = np.array(pil_image).astype(np.float32) / 255.0
-                image_tensor = torch.from_numpy(image_np)[None,]
-                output_images.append(image_tensor)
+        conditions = _encode_captions(clip, caption_texts)
 
-                caption_buffer.seek(0)
-                caption_text = caption_buffer.read().decode("utf-8").strip()
-                caption_texts.append(caption_text)
+        return (output_images, conditions, buckets, None, image_batches)
 
-                caption_cache_path = os.path.join(cache_folder, caption_file["name"])
-                with open(caption_cache_path, 'w', encoding='utf-8') as f:
-                    f.write(caption_text)
+    def _stream(self, pairs, clip, cache, client, download_workers, max_retries,
+                batch_size, resolution, bucket_mode, image_dtype="float32", pin_memory=False):
+        files = [f for name, image_file, caption_file in pairs for f in (image_file, caption_file)]
+        missing = [f for f in files if _blob_key(f) not in cache]
+        fetch = _cached_fetcher(cache, client, max_retries)
 
-            output_tensor = torch.cat(output_images, dim=0)
+        with cache.pinned(_blob_key(f) for f in files):
+            # Fill the cache without keeping anything decoded in memory.
+            _download_files(
+                client, missing, lambda file_info, data: None, download_workers, max_retries,
+                cache=cache,
+            )
+            dataset = GoogleDriveDataset(
+                pairs, clip, cache, fetch, batch_size, resolution, bucket_mode,
+                [_repeats(name) for name, image_file, caption_file in pairs], image_dtype, pin_memory,
+            )
 
-        conditions = []
-        empty_cond = clip.encode_from_tokens_scheduled(clip.tokenize(""))
-        for text in caption_texts:
-            if text == "":
-                conditions.append(empty_cond)
-            else:
-                tokens = clip.tokenize(text)
-                conditions.extend(clip.encode_from_tokens_scheduled(tokens))
+        # Encode captions up front in slices so iteration only reads the conditioning cache.
+        caption_files = [caption_file for name, image_file, caption_file in pairs]
+        for start in range(0, len(caption_files), CAPTION_ENCODE_BATCH):
+            caption_texts = [
+                _decode_pair_file(f, fetch(f))
+                for f in caption_files[start:start + CAPTION_ENCODE_BATCH]
+            ]
+            _encode_captions(clip, caption_texts)
 
-        return (output_tensor, conditions)
+        return (None, None, dataset.description(), dataset, None)
 
 class loadLoraFromGoogleDrive:
     @classmethod
@@ -455,77 +3042,295 @@ class loadLoraFromGoogleDrive:
                 "strength_model": ("FLOAT", {"default": 1.0, "min": -100.0, "max": 100.0, "step": 0.01, "tooltip": "How strongly to modify the diffusion model."}),
                 "strength_clip": ("FLOAT", {"default": 1.0, "min": -100.0, "max": 100.0, "step": 0.01, "tooltip": "How strongly to modify the CLIP model."}),
             },
+            "optional": {
+                "lora_ram_cache_mb": (
+                    "INT",
+                    {
+                        "default": 4096,
+                        "min": 0,
+                        "max": 262144,
+                        "tooltip": "RAM budget in MB for keeping loaded LoRAs in memory, so changing only the strengths needs no download or parsing. 0 disables it.",
+                    },
+                ),
+            },
         }
 
     RETURN_TYPES = ("MODEL", "CLIP")
     FUNCTION = "load_lora"
     CATEGORY = "cheap_trainer_utils"
     EXPERIMENTAL = True
-    DESCRIPTION = "Loads a LoRA from Google Drive and applies it to the model and CLIP."
+    DESCRIPTION = "Loads a LoRA from Google Drive through the local cache and applies it to the model and CLIP."
 
-    def load_lora(self, model, clip, folder_id, lora_name, credentials_json, strength_model, strength_clip):
+    @classmethod
+    def IS_CHANGED(s, folder_id, lora_name, credentials_json, **kwargs):
+        try:
+            lora_file = _lookup_lora_file(credentials_json, folder_id, lora_name)
+        except Exception:
+            return float("NaN")
+        return f"{lora_file['id']}:{lora_file.get('md5Checksum')}:{lora_file.get('modifiedTime')}"
+
+    @_instrumented
+    def load_lora(self, model, clip, folder_id, lora_name, credentials_json, strength_model, strength_clip,
+                  lora_ram_cache_mb=4096):
         if strength_model == 0 and strength_clip == 0:
             return (model, clip)
 
-        credentials_dict = json.loads(credentials_json)
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials_dict, scopes=["https://www.googleapis.com/auth/drive"]
-        )
+        lora_file = _lookup_lora_file(credentials_json, folder_id, lora_name)
 
-        drive_service = build("drive", "v3", credentials=credentials, cache_discovery=False)
+        _lora_state_cache.resize(lora_ram_cache_mb * 1024 * 1024)
+        state_key = (lora_file["id"], lora_file.get("md5Checksum"), lora_file.get("modifiedTime"))
+        lora = _lora_state_cache.get(state_key)
 
-        try:
-            folder_info = drive_service.files().get(
-                fileId=folder_id,
-                fields='id,name,mimeType'
-            ).execute()
-        except Exception as e:
-            raise ValueError(f"Cannot access folder {folder_id}: {e}")
+        if lora is None:
+            lora = self._load_state_dict(lora_file, lora_name, credentials_json)
+            _lora_state_cache.put(state_key, lora)
 
-        query = f"'{folder_id}' in parents and name='{lora_name}' and trashed=false"
-        results = (
-            drive_service.files()
-            .list(
-                q=query,
-                corpora='user',
-                includeItemsFromAllDrives=False,
-                supportsAllDrives=False,
-                fields="files(id, name)",
-                pageSize=1
+        model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip)
+        return (model_lora, clip_lora)
+
+    def _load_state_dict(self, lora_file, lora_name, credentials_json):
+        cache = _get_blob_cache()
+        key = _blob_key(lora_file)
+
+        client = _service_account_client(credentials_json)
+
+        def download_to(path):
+            if _is_large(lora_file):
+                _ranged_download_to_file(client, lora_file, path)
+                return
+
+            def attempt():
+                with client.borrow() as drive_service:
+                    _download_to_file(drive_service, lora_file, path)
+            _with_retries(attempt, 5, f"Download of {lora_name}")
+
+        compression = _file_compression(lora_name)
+        name = _strip_compression(lora_name)
+        if compression == "none":
+            with cache.pinned([key]):
+                return _load_lora_file(cache.fetch_file(key, download_to), name)
+
+        # Only the decompressed file is kept, so later loads can still memory-map it.
+        raw_key = hashlib.sha1(f"{compression}:{key}".encode("utf-8")).hexdigest()
+
+        def decompress_to(path):
+            with cache.pinned([key]):
+                _decompress_file(cache.fetch_file(key, download_to), path, compression)
+            cache.discard(key)
+
+        with cache.pinned([raw_key]):
+            return _load_lora_file(cache.fetch_file(raw_key, decompress_to), name)
+
+
+class packDatasetToGoogleDrive:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "folder_id": (
+                    "STRING",
+                    {
+                        "default": "",
+                        "tooltip": "Google Drive folder ID of the dataset to pack",
+                    },
+                ),
+                "client_id": (
+                    "STRING",
+                    {
+                        "default": "",
+                        "tooltip": "OAuth Client ID from Google Cloud Console",
+                    },
+                ),
+                "client_secret": (
+                    "STRING",
+                    {
+                        "default": "",
+                        "tooltip": "OAuth Client Secret from Google Cloud Console",
+                    },
+                ),
+                "refresh_token": (
+                    "STRING",
+                    {
+                        "multiline": True,
+                        "default": "",
+                        "tooltip": "OAuth Refresh Token (generate once using oauth_setup.py)",
+                    },
+                ),
+            },
+            "optional": {
+                "shard_size_mb": (
+                    "INT",
+                    {
+                        "default": 512,
+                        "min": 16,
+                        "max": 16384,
+                        "tooltip": "Maximum size of each archive shard in MB.",
+                    },
+                ),
+                "download_workers": (
+                    "INT",
+                    {
+                        "default": 8,
+                        "min": 1,
+                        "max": 64,
+                        "tooltip": "Number of files downloaded from Google Drive in parallel.",
+                    },
+                ),
+                "max_retries": (
+                    "INT",
+                    {
+                        "default": 5,
+                        "min": 0,
+                        "max": 20,
+                        "tooltip": "How many times a failed download or upload chunk is retried, with exponential backoff.",
+                    },
+                ),
+                "chunk_size_mb": (
+                    "INT",
+                    {
+                        "default": 8,
+                        "min": 1,
+                        "max": 1024,
+                        "tooltip": "Size of each resumable upload chunk in MB.",
+                    },
+                ),
+                "recursive": (
+                    "BOOLEAN",
+                    {
+                        "default": True,
+                        "tooltip": "Also pack pairs from subfolders, keeping their paths in the archive index.",
+                    },
+                ),
+            },
+        }
+
+    RETURN_TYPES = ()
+    FUNCTION = "pack_dataset"
+    CATEGORY = "cheap_trainer_utils"
+    EXPERIMENTAL = True
+    OUTPUT_NODE = True
+    DESCRIPTION = "Bundles the image-caption pairs of a Google Drive folder into a sharded archive with an index and uploads it to the same folder, so the pair loaders can fetch the dataset in a few bulk transfers."
+
+    @_instrumented
+    def pack_dataset(self, folder_id, client_id, client_secret, refresh_token, shard_size_mb=512,
+                     download_workers=8, max_retries=5, chunk_size_mb=8, recursive=True):
+        if not folder_id or len(folder_id.strip()) < 10:
+            raise ValueError(
+                "folder_id must be a valid Google Drive folder ID (the long string of letters/numbers), "
+                "not the folder name like 'My Dataset'."
             )
-            .execute()
-        )
 
-        files = results.get('files', [])
+        client = _oauth_client(client_id, client_secret, refresh_token)
+        client.refresh_if_needed()
+        client.check_folder(folder_id)
+
+        listing = _list_tree(client, folder_id, recursive, max_retries)
+        pairs = _pair_files([f for f in listing if _is_dataset_file(f["name"])])
 
-        if not files:
-            raise ValueError(f"LoRA file '{lora_name}' not found in Google Drive folder {folder_id}")
+        if not pairs:
+            raise ValueError("No matching image-caption pairs found in the folder!")
 
-        lora_file = files[0]
+        files = [f for name, image_file, caption_file in pairs for f in (image_file, caption_file)]
+        cache = _get_blob_cache()
+        work_dir = os.path.join(folder_paths.get_output_directory(), PACK_WORK_DIR, folder_id)
+        os.makedirs(work_dir, exist_ok=True)
+        pack_id = time.strftime("%Y%m%d%H%M%S")
 
-        request = drive_service.files().get_media(fileId=lora_file["id"])
-        file_buffer = BytesIO()
-        downloader = MediaIoBaseDownload(file_buffer, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
+        with cache.pinned(_blob_key(f) for f in files):
+            _download_files(
+                client, files, lambda file_info, data: None, download_workers, max_retries, cache=cache
+            )
+            with _stage("write_shards"):
+                shards, entries = self._write_shards(
+                    files, cache, client, work_dir, pack_id, shard_size_mb * 1024 * 1024, max_retries
+                )
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".safetensors") as temp_file:
-            temp_path = temp_file.name
-            file_buffer.seek(0)
-            temp_file.write(file_buffer.read())
+        chunk_size = chunk_size_mb * 1024 * 1024
+        for shard in shards:
+            with client.borrow() as drive_service:
+                _resumable_upload(
+                    drive_service, shard["path"], {"name": shard["name"], "parents": [folder_id]},
+                    chunk_size, max_retries,
+                )
+            os.remove(shard["path"])
+
+        # The index goes up last, so loaders never see it pointing at missing shards.
+        index = {
+            "version": 1,
+            "pack_id": pack_id,
+            "shards": [{"name": shard["name"], "size": shard["size"]} for shard in shards],
+            "files": entries,
+        }
+        existing = {f["name"]: f for f in listing}
+        index_file = existing.get(PACK_INDEX_NAME)
+
+        def upload_index():
+            with client.borrow() as drive_service:
+                return _upload_bytes(
+                    drive_service, json.dumps(index).encode("utf-8"),
+                    {"name": PACK_INDEX_NAME, "parents": [folder_id]}, "application/json",
+                    file_id=index_file["id"] if index_file else None,
+                )
+        _with_retries(upload_index, max_retries, f"Upload of {PACK_INDEX_NAME}")
+
+        new_shards = {shard["name"] for shard in shards}
+        for f in listing:
+            if f["name"].startswith(f"{PACK_PREFIX}.") and f["name"].endswith(".bin") \
+                    and f["name"] not in new_shards:
+                def delete_shard(file_id=f["id"]):
+                    with client.borrow() as drive_service:
+                        try:
+                            drive_service.files().delete(fileId=file_id).execute()
+                        except HttpError as e:
+                            # A retried delete may already have gone through.
+                            if e.resp.status != 404:
+                                raise
+                _with_retries(delete_shard, max_retries, f"Deletion of {f['name']}")
+
+        logging.info(
+            f"Packed {len(files)} files from Google Drive folder {folder_id} into {len(shards)} shards"
+        )
+        return {}
 
+    def _write_shards(self, files, cache, client, work_dir, pack_id, shard_size, max_retries):
+        shards = []
+        entries = []
+        locations = {}
+        shard_file = None
         try:
-            lora = comfy.utils.load_torch_file(temp_path, safe_load=True)
-            model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip)
-            return (model_lora, clip_lora)
+            for file_info in files:
+                key = _blob_key(file_info)
+                if key not in locations:
+                    data = cache.fetch(key, lambda: _fetch_bytes(client, file_info, max_retries))
+                    if shard_file is None or (shards[-1]["size"] and shards[-1]["size"] + len(data) > shard_size):
+                        if shard_file is not None:
+                            shard_file.close()
+                        name = f"{PACK_PREFIX}.{pack_id}.{len(shards):03}.bin"
+                        shards.append({"name": name, "path": os.path.join(work_dir, name), "size": 0})
+                        shard_file = open(shards[-1]["path"], "wb")
+                    shard_file.write(data)
+                    locations[key] = (len(shards) - 1, shards[-1]["size"], len(data))
+                    shards[-1]["size"] += len(data)
+                shard, offset, size = locations[key]
+                entries.append({
+                    "name": file_info["name"],
+                    "md5Checksum": key,
+                    "size": size,
+                    "shard": shard,
+                    "offset": offset,
+                })
         finally:
-            os.unlink(temp_path)
+            if shard_file is not None:
+                shard_file.close()
+        return shards, entries
+
 
+_start_prefetch()
 
 NODE_CLASS_MAPPINGS = {
     "Save Lora To Google Drive": SaveLoratoGoogleDrive,
     "Load Caption Image Pair From Google Drive": textImagePairFromGoogleDrive,
     "Load Caption Image Pair From Google Drive (Cached)": textImagePairFromGoogleDriveCached,
-    "Load Lora From Google Drive": loadLoraFromGoogleDrive
+    "Load Lora From Google Drive": loadLoraFromGoogleDrive,
+    "Pack Dataset To Google Drive": packDatasetToGoogleDrive
 }
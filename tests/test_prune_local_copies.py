@@ -0,0 +1,78 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+EXTENSION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The nodes import ComfyUI modules: use the checkout the extension is installed in
+# (`ComfyUI/custom_nodes/<extension>`) unless COMFYUI_PATH points to another one.
+sys.path.insert(0, os.environ.get("COMFYUI_PATH") or os.path.dirname(os.path.dirname(EXTENSION_DIR)))
+pytest.importorskip("folder_paths")
+
+
+@pytest.fixture(scope="module")
+def nodes(tmp_path_factory):
+    # Keep a prefetch.json next to the extension from downloading anything on import.
+    os.environ["CHEAP_TRAINER_PREFETCH_CONFIG"] = str(tmp_path_factory.mktemp("config") / "prefetch.json")
+    os.environ.pop("CHEAP_TRAINER_PREFETCH_FOLDERS", None)
+    spec = importlib.util.spec_from_file_location(
+        "cheaptrainerutils", os.path.join(EXTENSION_DIR, "cheaptrainerutils.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _write_copies(folder, names):
+    for age, name in enumerate(reversed(names)):
+        path = folder / name
+        path.write_bytes(b"")
+        mtime = 1_000_000 - age * 60
+        os.utime(path, (mtime, mtime))
+
+
+def test_prune_keeps_newest_copies(nodes, tmp_path):
+    _write_copies(tmp_path, [
+        "lora_00001_.safetensors",
+        "lora_00002_.safetensors.zst",
+        "lora_500_steps_00003_.safetensors.gz",
+    ])
+    nodes._prune_local_copies(str(tmp_path), "lora", 1)
+    assert sorted(os.listdir(tmp_path)) == ["lora_500_steps_00003_.safetensors.gz"]
+
+
+def test_prune_ignores_other_names_sharing_the_prefix(nodes, tmp_path):
+    _write_copies(tmp_path, [
+        "lora_00001_.safetensors",
+        "lora_style_00001_.safetensors",
+        "lora_00002_.safetensors",
+        "lora_style_00002_.safetensors",
+        "lora_notes.txt",
+    ])
+    nodes._prune_local_copies(str(tmp_path), "lora", 1)
+    assert sorted(os.listdir(tmp_path)) == [
+        "lora_00002_.safetensors",
+        "lora_notes.txt",
+        "lora_style_00001_.safetensors",
+        "lora_style_00002_.safetensors",
+    ]
+
+
+def test_prune_skips_copies_still_uploading(nodes, tmp_path):
+    _write_copies(tmp_path, ["lora_00001_.safetensors", "lora_00002_.safetensors"])
+    uploading = os.path.abspath(tmp_path / "lora_00001_.safetensors")
+    nodes._prune_local_copies(str(tmp_path), "lora", 1, skip={uploading})
+    assert sorted(os.listdir(tmp_path)) == ["lora_00001_.safetensors", "lora_00002_.safetensors"]
+
+
+def test_next_counter_moves_past_names_on_drive(nodes):
+    names = [
+        "lora_00002_.safetensors",
+        "lora_500_steps_00007_.safetensors.zst",
+        "lora_style_00009_.safetensors",
+        "notes.txt",
+    ]
+    assert nodes._next_counter(names, "lora") == 8
+    assert nodes._next_counter(names, "lora", 12) == 12
+    assert nodes._next_counter([], "lora") == 1